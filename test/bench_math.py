@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# Comparison of the latexmath builders on a page full of formulae:
+# generation time, size of the page and resources the browser has
+# to fetch before the formulae are displayed. With "mathjax", the
+# MathJax script is downloaded (if the network is available) to give
+# an idea of the cost paid at each page load, typesetting excluded.
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+FORMULAE = 500
+MATHJAX = "https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.5/MathJax.js?config=TeX-MML-AM_CHTML"
+
+def make_doc(dir, builder):
+	path = os.path.join(dir, f"math-{builder}.thot")
+	with open(path, "w", encoding="utf8") as out:
+		out.write(f"@LATEXMATH={builder}\n@use latexmath\n")
+		out.write("====== Formulae ======\n\n")
+		for i in range(FORMULAE):
+			out.write(f"Let $x_{{{i}}} = \\frac{{a^{i % 7}}}{{\\sqrt{{b + {i}}}}}$ and $n$.\n\n")
+	return path
+
+def build(path, *args):
+	start = time.time()
+	subprocess.run([sys.executable, "-m", "thot.command", "--no-cache", *args, path],
+		cwd = TOP, check = True, stderr = subprocess.DEVNULL)
+	return time.time() - start
+
+def fetch(url):
+	try:
+		start = time.time()
+		with urllib.request.urlopen(url, timeout = 10) as input:
+			size = len(input.read())
+		return time.time() - start, size
+	except OSError:
+		return None, None
+
+with tempfile.TemporaryDirectory() as dir:
+	for builder in ["latex2mathml", "mathjax"]:
+		path = make_doc(dir, builder)
+		t = build(path)
+		html = os.path.splitext(path)[0] + ".html"
+		size = os.path.getsize(html)
+		with open(html, encoding="utf8") as input:
+			scripts = input.read().count("<script")
+		print("%-14s build %.2fs, page %d KB, %d script(s)" % (builder, t, size >> 10, scripts))
+	t, size = fetch(MATHJAX)
+	if t is None:
+		print("MathJax script not reachable: formulae of mathjax page are not displayed")
+	else:
+		print("MathJax script: %.2fs to fetch %d KB (before any typesetting)" % (t, size >> 10))
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# Micro-benchmark of the output of the generators: compare writing
+# small fragments (as done for a big table) directly to a text file
+# and through back.Output. "socket" mimics the request handler of
+# thot-view that encodes and sends each written string.
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from thot import back
+
+ROWS = 200000
+PATH = os.path.join(tempfile.gettempdir(), "thot-bench-output.html")
+
+def gen_table(out):
+	write = out.write
+	write('<table>\n')
+	for i in range(ROWS):
+		write('<tr>')
+		for j in range(3):
+			write('<td')
+			write(' align="left"')
+			write('>')
+			write("cell")
+			write('</td>')
+		write('</tr>\n')
+	write('</table>\n')
+
+class Socket:
+
+	def __init__(self):
+		self.file = open(PATH, "wb", buffering=0)
+
+	def write(self, text):
+		self.file.write(bytes(text, "UTF8"))
+
+	def close(self):
+		self.file.close()
+
+def bench(label, make, close, runs = 5):
+	best = None
+	for _ in range(runs):
+		start = time.time()
+		out = make()
+		gen_table(out)
+		close(out)
+		t = time.time() - start
+		if best is None or t < best:
+			best = t
+	print("%-12s %.3fs" % (label, best))
+
+bench("file",
+	lambda: open(PATH, "w", encoding="utf8"),
+	lambda out: out.close())
+bench("buffered",
+	lambda: back.Output(open(PATH, "w", encoding="utf8")),
+	lambda out: out.close())
+bench("socket",
+	lambda: Socket(),
+	lambda out: out.close(), 1)
+bench("buf. socket",
+	lambda: back.Output(Socket()),
+	lambda out: out.close())
+bench("memory",
+	lambda: back.Output(),
+	lambda out: out.get_bytes())
+os.remove(PATH)
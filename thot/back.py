@@ -23,11 +23,64 @@ import os.path
 import shutil
 import sys
 
+from thot import cache
 from thot import common
 from thot import i18n
 
 STDOUT = "<stdout>"
 
+# If True, the resources are relocated by hard links instead of copies.
+HARD_LINKS = False
+
+
+class Output:
+	"""Output collecting the written strings in a list of chunks, for
+	the outputs that are not buffered (like the pages of thot-view sent
+	on a socket). write() is directly the append method of the list,
+	that is cheaper than the write() of a text file. The generators
+	writing to files use the (already buffered) file itself.
+
+	If no stream is given, the text is only kept in memory and can be
+	retrieved with get_text() or get_bytes(). Else it is written to the
+	stream in one block by flush() or close(). The output must be
+	closed explicitly, possibly by using it in a with statement.
+	- stream -- stream to write to (or None),
+	- close -- if True, close() closes also the stream."""
+
+	def __init__(self, stream = None, close = True):
+		self.stream = stream
+		self.do_close = close
+		self.chunks = []
+		self.write = self.chunks.append
+
+	def flush(self):
+		"""Write the collected text to the stream."""
+		if self.stream is not None and self.chunks:
+			self.stream.write("".join(self.chunks))
+			self.chunks.clear()
+
+	def close(self):
+		"""Flush the text and close the stream."""
+		try:
+			self.flush()
+		finally:
+			if self.stream is not None and self.do_close:
+				self.stream.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def get_text(self):
+		"""Get the text written (or not yet flushed) as a string."""
+		return "".join(self.chunks)
+
+	def get_bytes(self, encoding = "utf8"):
+		"""Get the text written (or not yet flushed) as bytes."""
+		return self.get_text().encode(encoding)
+
 
 class Manager:
 	"""The manager is in charge of organizing where to put files invovled in
@@ -57,8 +110,35 @@ class Manager:
 
 	def relocate(self, spath, dpath):
 		"""Called to relocate a used path (spath) )into the current build path (dpath).
-		The default implementation just copies the file. Raise BackException
-		if there is an error."""
+		The default implementation copies the file (with its modification
+		time) or, if HARD_LINKS is set, makes a hard link when possible.
+		Nothing is done if dpath has already the same size and modification
+		time; the content is only compared when the times differ.
+		Raise BackException if there is an error."""
+		try:
+			sstat = os.stat(spath)
+		except FileNotFoundError:
+			raise common.BackException(f"file not found: {spath}")
+		try:
+			dstat = os.stat(dpath)
+			if os.path.samestat(sstat, dstat):
+				if HARD_LINKS:
+					return
+			elif dstat.st_size == sstat.st_size:
+				if dstat.st_mtime_ns == sstat.st_mtime_ns:
+					return
+				if cache.hash_file(spath) == cache.hash_file(dpath):
+					shutil.copystat(spath, dpath)
+					return
+			os.remove(dpath)
+		except FileNotFoundError:
+			pass
+		if HARD_LINKS:
+			try:
+				os.link(spath, dpath)
+				return
+			except OSError:
+				pass
 		try:
 			shutil.copyfile(spath, dpath)
 			shutil.copystat(spath, dpath)
@@ -215,10 +295,14 @@ class Generator:
 				self.out = open(self.get_out_path(), "w", encoding="utf8")
 
 	def closeMain(self):
-		"""Close the main output."""
-		if self.get_out_path() != STDOUT:
-			self.out.close()
-			self.out =None
+		"""Close the main output (if it is open)."""
+		if self.out is not None:
+			out = self.out
+			self.out = None
+			if out is sys.stdout:
+				out.flush()
+			else:
+				out.close()
 
 	def use_resource(self, path):
 		"""Declare a used resource in the generation of the current
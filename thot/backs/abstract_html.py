@@ -17,6 +17,7 @@
 """Abstract back-end for HTML generation from Thot."""
 
 import html
+import io
 import os
 import re
 
@@ -93,10 +94,19 @@ class Relocator:
 		"""Move the file from source path to the target path and
 		perform relocation of references in side the source file.
 		ref is the path of the resource
-		If there is an error, must raise a BackException."""
-		output = open(tpath, "w", encoding="utf8")
+		If there is an error, must raise a BackException.
+		The target file is not written if its content does not change."""
+		output = io.StringIO()
 		self.move_to_stream(spath, tpath, output, man)
-		output.close()
+		text = output.getvalue()
+		try:
+			with open(tpath, encoding="utf8") as input:
+				if input.read() == text:
+					return
+		except (OSError, UnicodeDecodeError):
+			pass
+		with open(tpath, "w", encoding="utf8") as out:
+			out.write(text)
 
 	def move_to_stream(self, spath, tpath, output, man):
 		"""Move file spath and relocates the content to the output
@@ -111,30 +121,42 @@ class CSSRelocator(Relocator):
 
 	def __init__(self):
 		Relocator.__init__(".css")
+		self.parsed = {}
 
-	def move_to_stream(self, spath, tpath, output, man):
-
-		# open files
+	def parse(self, spath):
+		"""Split the CSS file into a list of (text, URL) pairs (URL may
+		be None). The result is memoized as long as the size and the
+		modification time of the file do not change."""
 		try:
-			input = open(spath, encoding="utf8")
-		except FileNotFoundError as e:
-			raise common.BackException(str(e))
+			stat = os.stat(spath)
+		except OSError:
+			raise common.BackException(f"file not found: {spath}")
+		key = (spath, stat.st_size, stat.st_mtime_ns)
+		try:
+			return self.parsed[key]
+		except KeyError:
+			pass
+		parts = []
+		with open(spath, encoding="utf8") as input:
+			text = input.read()
+		pos = 0
+		for m in CSSRelocator.CSS_URL_RE.finditer(text):
+			parts.append((text[pos:m.start()], m.group(1)))
+			pos = m.end()
+		parts.append((text[pos:], None))
+		self.parsed[key] = parts
+		return parts
 
-		# perform the copy
+	def move_to_stream(self, spath, tpath, output, man):
 		dir = os.path.dirname(spath)
-		for line in input:
-			m = CSSRelocator.CSS_URL_RE.search(line)
-			while m:
-				output.write(line[:m.start()])
-				url = m.group(1)
+		for (text, url) in self.parse(spath):
+			output.write(text)
+			if url is not None:
 				if ":" not in url:
 					path = os.path.join(dir, url)
 					rpath = man.use_resource(path)
 					url = man.get_resource_link(rpath, tpath)
 				output.write(f"url({url})")
-				line = line[m.end():]
-				m = CSSRelocator.CSS_URL_RE.search(line)
-			output.write(line)
 
 
 # Known relocators
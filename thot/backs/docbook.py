@@ -81,6 +81,16 @@ class Generator(back.Generator):
 
 	def run(self):
 		self.openMain()
+		try:
+			self.gen_main()
+		finally:
+			self.closeMain()
+
+		# run the backend
+		self.run_backend()
+
+	def gen_main(self):
+		"""Generate the DocBook document in the main output."""
 
 		# generate document header
 		self.doc.pregen(self)
@@ -117,9 +127,9 @@ class Generator(back.Generator):
 		self.doc.gen(self)
 		self.out.write('</book>\n')
 
-		# run the backend
+	def run_backend(self):
+		"""Run the back-end tool producing the final format."""
 		if self.output == 'pdf':
-			self.out.close()
 			name, _ = os.path.splitext(self.get_out_path())
 			if self.backend == 'dblatex':
 				cmd = f'dblatex {self.get_out_path()} -o {name + ".pdf"}'
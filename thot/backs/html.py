@@ -178,10 +178,13 @@ class AllInOne(PagePolicy):
 
 	def run(self):
 		self.gen.openMain()
-		self.file = os.path.abspath(self.gen.get_out_path())
-		self.make_numbers(self.gen.doc)
-		self.gen.doc.pregen(self.gen)
-		self.page.apply(self, self.gen)
+		try:
+			self.file = os.path.abspath(self.gen.get_out_path())
+			self.make_numbers(self.gen.doc)
+			self.gen.doc.pregen(self.gen)
+			self.page.apply(self, self.gen)
+		finally:
+			self.gen.closeMain()
 
 
 class PerChapter(PagePolicy):
@@ -233,19 +236,25 @@ class PerChapter(PagePolicy):
 
 		# preparation
 		self.gen.openMain()
-		self.file = os.path.abspath(self.gen.get_out_path())
-		self.make_numbers(self.gen.doc)
-		self.gen.doc.pregen(self.gen)
+		try:
+			self.file = os.path.abspath(self.gen.get_out_path())
+			self.make_numbers(self.gen.doc)
+			self.gen.doc.pregen(self.gen)
 
-		# generate first page
-		self.page.apply(self, self.gen)
+			# generate first page
+			self.page.apply(self, self.gen)
+		finally:
+			self.gen.closeMain()
 		self.gen.info("generated %s", self.gen.get_out_path())
 
 		# generate chapter pages
 		for (name, header) in self.todo:
 			self.current = header
 			self.gen.openPage(name)
-			self.page.apply(self, self.gen)
+			try:
+				self.page.apply(self, self.gen)
+			finally:
+				self.gen.closePage()
 			self.gen.info("generated %s", name)
 
 
@@ -398,7 +407,7 @@ class Generator(abstract_html.Generator):
 		self.footnotes = []
 
 	def closePage(self):
-		self.out.close()
+		self.closeMain()
 
 	def run(self):
 
@@ -17,14 +17,19 @@
 """Latex back-end for Thot."""
 
 import codecs
+import concurrent.futures
+import hashlib
 import os.path
+import pickle
+import shlex
 import subprocess
-import sys
 import unicodedata
 
 from thot import back
+from thot import cache
 from thot import common
 from thot import doc
+from thot import jobs
 
 
 KOMA_STYLES = [
@@ -101,7 +106,40 @@ STYLES = {
 	'emphasized': '\\emph{'
 }
 
-UNSUPPORTED_IMAGE = [ '.gif' ]
+
+class Converter:
+	"""Converter of an image format unsupported by pdflatex into
+	a supported one. cmd is the shell command performing the conversion
+	where {src} and {dst} are replaced by the source and destination
+	paths."""
+
+	def __init__(self, ext, cmd):
+		self.ext = ext
+		self.cmd = cmd
+
+	def convert(self, src, dst):
+		"""Convert src to dst. Return None for success, an error message
+		else."""
+		cmd = self.cmd.format(src = shlex.quote(src), dst = shlex.quote(dst))
+		common.onVerbose(lambda _: f"CMD: {cmd}")
+		try:
+			proc = subprocess.run(cmd, shell = True, check = False,
+				stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+			if proc.returncode != 0:
+				return proc.stdout.decode("utf8", "replace").strip()
+			return None
+		except OSError as e:
+			return str(e)
+
+
+# converters by source extension (may be extended)
+CONVERTERS = {
+	'.gif': Converter('.png', 'convert {src} {dst}'),
+	'.svg': Converter('.pdf', 'rsvg-convert -f pdf -o {dst} {src}')
+}
+UNSUPPORTED_IMAGE = list(CONVERTERS)
+AUX_EXTS = [ '.aux', '.toc', '.out', '.lof', '.lot' ]
+DEFAULT_MAX_RUNS = 5
 
 ALIGNMENT = ['l', 'c', 'r']
 
@@ -165,6 +203,7 @@ class Generator(back.Generator):
 
 	def __init__(self, doc, out=None):
 		back.Generator.__init__(self, doc, out=out)
+		self.conversions = {}
 
 	def escape(self, text):
 		res = ""
@@ -186,6 +225,24 @@ class Generator(back.Generator):
 
 	def run(self):
 		self.openMain()
+		try:
+			self.gen_main()
+		finally:
+			self.closeMain()
+		self.convert_images()
+
+		# generate final format
+		output = self.doc.getVar('OUTPUT')
+		if not output or output == 'latex':
+			print(f"SUCCESS: result in {self.get_out_path()}")
+		elif output == 'pdf':
+			if self.make_pdf():
+				print(f"SUCCESS: result in {self.get_pdf_path()}")
+		else:
+			common.onError(f'unknown output: {output}')
+
+	def gen_main(self):
+		"""Generate the LaTeX document in the main output."""
 		self.doc.pregen(self)
 
 		# get class
@@ -299,44 +356,6 @@ class Generator(back.Generator):
 
 		# write footer
 		self.out.write('\\end{document}\n')
-		self.out.close()
-
-		# generate final format
-		output = self.doc.getVar('OUTPUT')
-		if not output or output == 'latex':
-			print(f"SUCCESS: result in {self.get_out_path()}")
-		elif output == 'pdf':
-
-			# perform compilation
-			for _ in range(2):	# two times for TOC (sorry)
-				dir, file = os.path.split(self.get_out_path())
-				cmd = f'pdflatex -halt-on-error {file}'
-				if dir == "":
-					dir = "."
-				process = subprocess.Popen(
-					cmd,
-					shell = True,
-					stdout = subprocess.PIPE,
-					stderr = subprocess.PIPE,
-					cwd = dir
-				)
-				out, err = process.communicate('')
-				print(out)
-				if process.returncode != 0:
-					sys.stdout.write(out)
-					sys.stderr.write(err)
-					return
-
-			# display result
-			file, ext = os.path.splitext(self.get_out_path())
-			if ext == ".tex":
-				path = file
-			else:
-				path = self.get_out_path()
-			path = path + ".pdf"
-			print(f"SUCCESS: result in {path}")
-		else:
-			common.onError(f'unknown output: {output}')
 
 	def genFootNote(self, note):
 		self.out.write('\\footnote{')
@@ -488,6 +507,168 @@ class Generator(back.Generator):
 	def genLinkBegin(self, url, title = None):
 		self.out.write(f'\\href{{{self.escape(url)}}}{{')
 
+	def get_pdf_path(self):
+		"""Get the path of the produced PDF file."""
+		file, ext = os.path.splitext(self.get_out_path())
+		if ext == ".tex":
+			path = file
+		else:
+			path = self.get_out_path()
+		return path + ".pdf"
+
+	def get_inputs_hash(self):
+		"""Compute a hash of the content of the .tex file and of the
+		resources it uses."""
+		paths = set(self.manager.map.values())
+		if os.path.isdir(self.manager.import_dir):
+			for (dir, _, files) in os.walk(self.manager.import_dir):
+				for file in files:
+					paths.add(os.path.join(dir, file))
+		h = hashlib.sha1()
+		for path in [self.get_out_path()] + sorted(paths):
+			h.update(f"{path}\0{cache.hash_file(path)}\0".encode("utf8"))
+		return h.hexdigest()
+
+	def get_aux_hashes(self, root):
+		"""Get the hashes of the auxiliary files produced by pdflatex."""
+		return [cache.hash_file(root + ext) for ext in AUX_EXTS]
+
+	def make_pdf(self):
+		"""Compile the .tex file to PDF. pdflatex is run again until the
+		auxiliary files do not change anymore (at most LATEX_MAX_RUNS times)
+		and not run at all if the .tex file and the used resources did
+		not change since the last build. Return True for success."""
+		path = self.get_out_path()
+		dir, file = os.path.split(path)
+		if dir == "":
+			dir = "."
+		root = os.path.splitext(path)[0]
+		pdf = self.get_pdf_path()
+
+		# up to date?
+		state_path = os.path.join(cache.get_dir(self.doc.env, "latex"),
+			cache.make_key(os.path.abspath(pdf)))
+		inputs = self.get_inputs_hash()
+		if cache.ENABLED:
+			try:
+				with open(state_path, "rb") as input:
+					state = pickle.load(input)
+				if state == (inputs, cache.hash_file(pdf)):
+					self.info("%s is up to date", pdf)
+					return True
+			except (OSError, pickle.PickleError, EOFError):
+				pass
+
+		# run pdflatex until the auxiliary files converge
+		try:
+			max_runs = int(self.doc.getVar("LATEX_MAX_RUNS", DEFAULT_MAX_RUNS))
+		except ValueError:
+			max_runs = DEFAULT_MAX_RUNS
+		max_runs = max(1, max_runs)
+		aux = self.get_aux_hashes(root)
+		runs = 0
+		converged = False
+		while runs < max_runs and not converged:
+			runs += 1
+			common.onVerbose(lambda _: f"CMD: pdflatex -halt-on-error {file}")
+			process = subprocess.run(
+				["pdflatex", "-halt-on-error", "-interaction=nonstopmode", file],
+				stdin = subprocess.DEVNULL,
+				stdout = subprocess.PIPE,
+				stderr = subprocess.STDOUT,
+				cwd = dir,
+				check = False
+			)
+			log = process.stdout.decode("utf8", "replace")
+			common.onVerbose(lambda _: log)
+			if process.returncode != 0:
+				self.summarize_errors(log, root + ".log")
+				return False
+			new_aux = self.get_aux_hashes(root)
+			converged = new_aux == aux
+			aux = new_aux
+		if not converged:
+			self.warn("references may be wrong: auxiliary files still change after %d runs", runs)
+		self.summarize_warnings(log, runs, root + ".log")
+
+		# record the state
+		if cache.ENABLED:
+			with open(state_path, "wb") as out:
+				pickle.dump((inputs, cache.hash_file(pdf)), out)
+		return True
+
+	def summarize_errors(self, log, log_path):
+		"""Display the errors found in the output of pdflatex."""
+		lines = log.split("\n")
+		for (i, line) in enumerate(lines):
+			if line.startswith("!"):
+				msg = line[1:].strip()
+				for next in lines[i+1:i+10]:
+					if next.startswith("l."):
+						msg = f"{msg} ({next.strip()})"
+						break
+				self.error("pdflatex: %s", msg)
+		self.error("pdflatex failed: see %s", log_path)
+
+	def summarize_warnings(self, log, runs, log_path):
+		"""Display a summary of the warnings of the last pdflatex run."""
+		warnings = 0
+		boxes = 0
+		for line in log.split("\n"):
+			if "Warning:" in line:
+				warnings += 1
+			elif line.startswith("Overfull") or line.startswith("Underfull"):
+				boxes += 1
+		self.info("pdflatex: %d run(s), %d warning(s), %d bad box(es) (see %s)",
+			runs, warnings, boxes, log_path)
+
+	def convert_image(self, url, converter):
+		"""Get the path of the converted image. The conversion itself is
+		performed later by convert_images()."""
+		src = os.path.abspath(url)
+		try:
+			return self.conversions[src][0]
+		except KeyError:
+			pass
+		root = os.path.splitext(os.path.basename(url))[0]
+		dst = self.new_resource(f"convert/{root}-{cache.make_key(src)[:8]}{converter.ext}")
+		self.conversions[src] = (dst, converter)
+		return dst
+
+	def convert_images(self):
+		"""Perform the image conversions that are not up to date:
+		conversions are skipped if the converted image is newer than
+		the source or if the result is found in the "convert" cache.
+		The other ones are run in parallel. Raise BackException if
+		a conversion fails."""
+		files = cache.get_files(self.doc.env, "convert")
+		todo = []
+		for (src, (dst, converter)) in self.conversions.items():
+			try:
+				if os.path.getmtime(dst) >= os.path.getmtime(src):
+					continue
+			except OSError:
+				pass
+			key = cache.make_key(converter.cmd, str(cache.hash_file(src)))
+			if not files.get(key, dst, converter.ext):
+				todo.append((src, dst, converter, key))
+
+		def convert(src, dst, converter, key):
+			msg = converter.convert(src, dst)
+			if msg is None:
+				files.put(key, dst, converter.ext)
+			return msg
+		with concurrent.futures.ThreadPoolExecutor(max(jobs.WORKERS, 1)) as pool:
+			futures = [pool.submit(convert, *args) for args in todo]
+		failed = 0
+		for ((src, dst, _, _), future) in zip(todo, futures):
+			msg = future.result()
+			if msg is not None:
+				self.error('cannot convert image "%s" to "%s": %s', src, dst, msg)
+				failed += 1
+		if failed:
+			raise common.BackException(f"{failed} image(s) cannot be converted")
+
 	def genLinkEnd(self, url):
 		self.out.write('}')
 
@@ -497,15 +678,11 @@ class Generator(back.Generator):
 		# !!TODO!!
 
 		# handle unsupported image format
-		root, ext = os.path.splitext(url)
-		if ext.lower() not in UNSUPPORTED_IMAGE:
+		_, ext = os.path.splitext(url)
+		try:
+			link = self.convert_image(url, CONVERTERS[ext.lower()])
+		except KeyError:
 			link = self.use_resource(url)
-		else:
-			root, ext = os.path.splitext(url)
-			link = self.use_resource(os.path.abspath(root + ".png"))
-			res = subprocess.call([f'convert {url} {link}'], shell = True)
-			if res != 0:
-				common.onError(f'cannot convert image "{url}" to "{link}"')
 		link = self.get_resource_path(link)
 
 		# build the command
@@ -594,6 +771,7 @@ __vars__ = common.make_var_doc([
 	("LATEX_CLASS",		"latex class for document (default book)"),
 	("LATEX_PAPER",		"latex paper format (a4paper, letter, etc)"),
 	("LATEX_PREAMBLE",	"to be inserted just after document definition"),
+	("LATEX_MAX_RUNS",	"maximum number of pdflatex runs to resolve references (default 5, at least 1)"),
 	("OUTPUT",			"one of 'latex' (latex output) or 'pdf' (latex and PDF output)")
 ])
 
@@ -81,6 +81,7 @@ class Generator:
 
 	def genManifest(self):
 		"""Generate the ismmanifest."""
+		out = None
 		try:
 			out = open("imsmanifest.xml", "w", encoding="utf8")
 			self.pack_files.append("imsmanifest.xml")
@@ -146,9 +147,11 @@ class Generator:
 
 			# close all
 			out.write("</manifest>\n")
-			out.close()
 		except IOError as e:
 			raise common.BackException(str(e))
+		finally:
+			if out is not None:
+				out.close()
 
 	def run(self):
 		self.doc.setVar("HTML_ONE_FILE_PER", "chapter")
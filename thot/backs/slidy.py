@@ -175,6 +175,8 @@ class Generator(abstract_html.Generator):
 
 		except IOError as e:
 			common.onError(f"error during generation: {e}")
+		finally:
+			self.closeMain()
 
 	def gen_imported_style(self, env, out):
 		if self.rel_css:
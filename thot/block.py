@@ -23,11 +23,13 @@ a comma-separated list of options.
 """
 
 import re
+import threading
 
 from thot import common, doc, tparser
 from thot.common import ParseException
 
 ARG_RE = re.compile(r"[\s]*([\S]+)[\s]*=(.*)")
+NUM_LOCK = threading.Lock()
 
 class OptionException(Exception):
 	option = None
@@ -253,6 +255,7 @@ class Syntax(tparser.Syntax):
 
 	def new_num(self):
 		"""Return a new unique number."""
-		r = self.count
-		self.count = self.count + 1
+		with NUM_LOCK:
+			r = self.count
+			self.count = self.count + 1
 		return r
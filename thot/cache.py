@@ -0,0 +1,356 @@
+# cache -- on-disk caches of Thot
+# Copyright (C) 2024  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""On-disk caches used to avoid re-doing work between runs of Thot.
+The caches are stored in the directory given by the variable
+THOT_CACHE_DIR (default to $XDG_CACHE_HOME/thot or ~/.cache/thot)."""
+
+import hashlib
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+from thot import common
+from thot import serial
+
+ENABLED = True
+DEFAULT_SIZE = 512		# in MB
+FILE_CACHES = {}
+FILE_HASHES = {}
+CORE_VERSION = None
+
+
+def get_root(env):
+	"""Get the root directory of the caches."""
+	root = env["THOT_CACHE_DIR"]
+	if not root:
+		root = os.environ.get("XDG_CACHE_HOME")
+		if not root:
+			root = os.path.join(os.path.expanduser("~"), ".cache")
+		root = os.path.join(root, "thot")
+	return root
+
+
+def get_dir(env, name):
+	"""Get (and create if needed) the cache directory of the given name."""
+	path = os.path.join(get_root(env), name)
+	os.makedirs(path, exist_ok=True)
+	return path
+
+
+def clear(env):
+	"""Remove all the caches."""
+	FILE_CACHES.clear()
+	shutil.rmtree(get_root(env), ignore_errors=True)
+
+
+def make_key(*parts):
+	"""Build a cache key from the given strings."""
+	return hashlib.sha1("\0".join(parts).encode("utf8")).hexdigest()
+
+
+class FileCache:
+	"""Cache of files (typically images produced by external commands)
+	addressed by a key computed from the content producing them. When
+	the cache is bigger than its limit, the least recently used files
+	are removed. The limit is given by THOT_CACHE_SIZE in MB."""
+
+	def __init__(self, env, name):
+		self.dir = get_dir(env, name)
+		try:
+			self.limit = int(env.get("THOT_CACHE_SIZE", DEFAULT_SIZE)) << 20
+		except ValueError:
+			self.limit = DEFAULT_SIZE << 20
+		self.size = None
+
+	def get_path(self, key, ext = ""):
+		"""Get the path of the cached file for the key."""
+		return os.path.join(self.dir, key + ext)
+
+	def get(self, key, path, ext = ""):
+		"""Copy the file cached for the key to path. Return True if
+		the file was in the cache, False else."""
+		if not ENABLED:
+			return False
+		cpath = self.get_path(key, ext)
+		try:
+			shutil.copyfile(cpath, path)
+			os.utime(cpath)
+			return True
+		except OSError:
+			return False
+
+	def put(self, key, path, ext = ""):
+		"""Record the file at path in the cache for the given key."""
+		if not ENABLED or not os.path.isfile(path):
+			return
+		self.store(key, ext, lambda tmp: shutil.copyfile(path, tmp))
+
+	def get_text(self, key, ext = ""):
+		"""Get the text cached for the key or None."""
+		if not ENABLED:
+			return None
+		cpath = self.get_path(key, ext)
+		try:
+			with open(cpath, encoding="utf8") as file:
+				text = file.read()
+			os.utime(cpath)
+			return text
+		except OSError:
+			return None
+
+	def put_text(self, key, text, ext = ""):
+		"""Record the text in the cache for the given key."""
+		if not ENABLED:
+			return
+		def write(tmp):
+			with open(tmp, "w", encoding="utf8") as file:
+				file.write(text)
+		self.store(key, ext, write)
+
+	def store(self, key, ext, make):
+		"""Atomically build the cached file for the key: make is called
+		with a temporary path to fill."""
+		tmp = None
+		try:
+			fd, tmp = tempfile.mkstemp(dir=self.dir)
+			os.close(fd)
+			make(tmp)
+			size = os.path.getsize(tmp)
+			os.replace(tmp, self.get_path(key, ext))
+		except OSError:
+			if tmp is not None and os.path.exists(tmp):
+				os.remove(tmp)
+			return
+		if self.size is not None:
+			self.size += size
+		self.evict()
+
+	def evict(self):
+		"""Remove the least recently used files until the cache size is
+		under the limit. The directory is only scanned at the first call
+		or when the estimated size exceeds the limit."""
+		if self.size is not None and self.size <= self.limit:
+			return
+		files = []
+		size = 0
+		for entry in os.scandir(self.dir):
+			try:
+				stat = entry.stat()
+			except OSError:
+				continue
+			files.append((stat.st_mtime, stat.st_size, entry.path))
+			size += stat.st_size
+		self.size = size
+		if size <= self.limit:
+			return
+		files.sort()
+		for (_, fsize, path) in files:
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			size -= fsize
+			self.size = size
+			if size <= self.limit:
+				break
+
+
+def get_files(env, name):
+	"""Get the file cache of the given name."""
+	try:
+		return FILE_CACHES[name]
+	except KeyError:
+		fcache = FileCache(env, name)
+		FILE_CACHES[name] = fcache
+		return fcache
+
+
+def hash_file(path):
+	"""Compute the hash of the content of the given file.
+	Return None if the file cannot be read."""
+	try:
+		with open(path, "rb") as file:
+			return hashlib.sha1(file.read()).hexdigest()
+	except OSError:
+		return None
+
+
+def get_file_hash(path):
+	"""Same as hash_file() but the hash is memoized as long as the size
+	and the modification time of the file do not change."""
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	sign = (stat.st_size, stat.st_mtime_ns)
+	try:
+		osign, hash = FILE_HASHES[path]
+		if osign == sign:
+			return hash
+	except KeyError:
+		pass
+	hash = hash_file(path)
+	FILE_HASHES[path] = (sign, hash)
+	return hash
+
+
+def module_version(path):
+	"""Get the version of the module of the given path: its __version__,
+	if any, and the modification time of its file."""
+	try:
+		mtime, mod = common.MODULES[path]
+	except KeyError:
+		return None
+	return (mod.__dict__.get("__version__"), mtime)
+
+
+def core_version():
+	"""Get the version of the core code of Thot: a hash of the names,
+	sizes and modification times of the Python files of the thot
+	package. It is computed once per process."""
+	global CORE_VERSION
+	if CORE_VERSION is None:
+		dir = os.path.dirname(os.path.abspath(__file__))
+		sign = hashlib.sha1(common.VERSION.encode("utf8"))
+		for name in sorted(os.listdir(dir)):
+			if name.endswith(".py"):
+				stat = os.stat(os.path.join(dir, name))
+				sign.update(f"\0{name}\0{stat.st_size}\0{stat.st_mtime_ns}"
+					.encode("utf8"))
+		CORE_VERSION = sign.hexdigest()
+	return CORE_VERSION
+
+
+class Recorder:
+	"""Output stream recording the text written to another stream."""
+
+	def __init__(self, out):
+		self.out = out
+		self.text = []
+
+	def write(self, text):
+		self.text.append(text)
+		return self.out.write(text)
+
+	def flush(self):
+		self.out.flush()
+
+
+class DocumentCache:
+	"""Cache of the parsed document: the document is re-used if the input
+	files, the used modules, the core code of Thot, the defines and the
+	output type are the same as in the previous run. The messages
+	displayed during the parsing are displayed again when the document
+	is loaded from the cache.
+
+	The input files are the ones recorded by tparser.Manager.add_input()
+	(included files, even missing ones, Doxygen tag files): a module
+	reading another file while parsing has to record it. Notice also
+	that, on a cache hit, the modules are loaded but their init() is not
+	called: it must only prepare the parsing or record its effects in
+	the document.
+	- env -- environment of the document (before parsing),
+	- path -- path of the main file,
+	- defines -- definitions of the command line (NAME=VALUE),
+	- uses -- modules used from the command line,
+	- mon -- monitor to display messages."""
+
+	def __init__(self, env, path, defines = None, uses = None,
+	mon = common.DEFAULT_MONITOR):
+		self.env = env
+		self.path = os.path.abspath(path)
+		self.mon = mon
+		self.init_env = dict(env.map)
+		self.messages = ""
+		key = "\0".join([common.VERSION, self.path, os.getcwd(),
+			env["THOT_OUT_TYPE"]]
+			+ sorted(defines if defines is not None else [])
+			+ ["-u"] + (uses if uses is not None else []))
+		self.file = os.path.join(get_dir(env, "docs"),
+			hashlib.sha1(key.encode("utf8")).hexdigest() + ".pickle")
+
+	def load(self, man):
+		"""Try to load the document from the cache and install it in the
+		manager. Return the document or None."""
+		try:
+			with open(self.file, "rb") as file:
+				unpickler = serial.Unpickler(file)
+				files, mods, core = unpickler.load()
+				if core != core_version():
+					return None
+				for (path, hash) in files:
+					if hash_file(path) != hash:
+						return None
+				for (path, version) in mods:
+					if not os.path.exists(path):
+						return None
+					common.loadModule(
+						os.path.splitext(os.path.basename(path))[0],
+						os.path.dirname(path))
+					if module_version(path) != version:
+						return None
+				env, used, messages = unpickler.load()
+				document = serial.load(file, self.env)
+		except FileNotFoundError:
+			return None
+		except Exception as e:
+			self.mon.say("cannot load cached document %s: %s", self.file, e)
+			return None
+		self.env.map.update(env)
+		man.doc = document
+		man.used_mods = used
+		sys.stderr.write(messages)
+		self.mon.say("document loaded from cache %s", self.file)
+		return document
+
+	def parse(self, man, input, name):
+		"""Parse the document with the manager and record the displayed
+		messages. Raise common.ParseException in case of error."""
+		err = Recorder(sys.stderr)
+		save_err, save_mon = sys.stderr, man.mon.err
+		sys.stderr = err
+		man.mon.err = err
+		try:
+			man.parse(input, name)
+		finally:
+			sys.stderr = save_err
+			man.mon.err = save_mon
+		self.messages = "".join(err.text)
+
+	def save(self, man):
+		"""Store the document parsed by the manager in the cache."""
+		files = [(path, hash_file(path))
+			for path in [self.path] + man.inputs]
+		mods = [(path, module_version(path)) for path in common.MODULES]
+		env = {k: v for (k, v) in self.env.map.items()
+			if self.init_env.get(k) != v}
+		tmp = None
+		try:
+			fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.file))
+			with os.fdopen(fd, "wb") as file:
+				pickler = serial.Pickler(file)
+				pickler.dump((files, mods, core_version()))
+				pickler.dump((env, man.used_mods, self.messages))
+				file.flush()
+				serial.dump(man.doc, file, False)
+			os.replace(tmp, self.file)
+		except Exception as e:
+			self.mon.say("cannot cache document: %s", e)
+			if tmp is not None and os.path.exists(tmp):
+				os.remove(tmp)
@@ -24,8 +24,11 @@ import os
 import os.path
 import sys
 
+from thot import back
+from thot import cache
 from thot import common
 from thot import doc
+from thot import jobs
 from thot import tparser
 
 
@@ -162,6 +165,14 @@ def main():
 		help="list the content of a module")
 	parser.add_argument("--list-avail", dest = "list_avail", action="store_true", default=False,
 		help="list available modules")
+	parser.add_argument("--no-cache", dest="no_cache", action="store_true", default=False,
+		help="do not use the caches (parsed documents, external tools)")
+	parser.add_argument("--clear-cache", dest="clear_cache", action="store_true", default=False,
+		help="remove the content of the caches")
+	parser.add_argument("--hard-links", dest="hard_links", action="store_true", default=False,
+		help="relocate the resources by hard links instead of copies")
+	parser.add_argument("-j", "--jobs", action="store", dest="jobs", type=int,
+		help="number of external tools run in parallel (default number of processors)")
 	parser.add_argument("--version", action="store_true", default=False,
 		help="print version")
 	parser.add_argument("file", nargs="?", help="File to convert.")
@@ -176,6 +187,9 @@ def main():
 		sys.exit()
 	if args.encoding:
 		common.ENCODING = args.encoding
+	if args.jobs is not None:
+		jobs.WORKERS = args.jobs
+	back.HARD_LINKS = args.hard_links
 	env["THOT_OUT_TYPE"] = args.out_type
 	if not args.out_path:
 		env["THOT_OUT_PATH"] = ""
@@ -211,6 +225,14 @@ def main():
 	if not out_driver:
 		mon.fatal(f'cannot find {out_name} back-end')
 
+	# manage the caches
+	if args.no_cache:
+		cache.ENABLED = False
+	if args.clear_cache:
+		cache.clear(env)
+		if file is None:
+			sys.exit(0)
+
 	# list available modules
 	if args.list_avail:
 		list_avail_modules(document)
@@ -228,7 +250,16 @@ def main():
 	if args.uses:
 		for u in args.uses:
 			man.use(u)
-	man.parse(input, env['THOT_FILE'])
+	if file is None or args.no_cache:
+		man.parse(input, env['THOT_FILE'])
+	else:
+		doc_cache = cache.DocumentCache(env, file, args.defines, args.uses, mon)
+		cached = doc_cache.load(man)
+		if cached is not None:
+			document = cached
+		else:
+			doc_cache.parse(man, input, env['THOT_FILE'])
+			doc_cache.save(man)
 
 	# dump the parsed document
 	if args.dump:
@@ -24,6 +24,7 @@ import os.path
 import re
 import subprocess
 import sys
+import threading
 import traceback
 
 VERSION = "2.2"
@@ -74,14 +75,24 @@ class CommandException(ThotException):
 
 IS_VERBOSE = False
 ENCODING = "UTF-8"
+MESSAGES = threading.local()
+
+
+def write_message(text):
+	"""Display a message to the user. When called from a job (see module
+	jobs), the message is recorded to be displayed later."""
+	messages = getattr(MESSAGES, "list", None)
+	if messages is None:
+		sys.stderr.write(text)
+	else:
+		messages.append(text)
 
 
 def onVerbose(f):
 	"""Invoke and display the result of the given function if verbose
 	mode is activated."""
 	if IS_VERBOSE:
-		sys.stderr.write(f(()))
-		sys.stderr.write("\n")
+		write_message(f"{f(())}\n")
 
 
 def show_stack():
@@ -96,44 +107,63 @@ def onParseError(msg):
 def onError(text):
 	"""Display the given error and stop the application."""
 	onVerbose(lambda _: show_stack())
-	sys.stderr.write(f"ERROR: {text}\n")
+	write_message(f"ERROR: {text}\n")
 	sys.exit(1)
 
 
 def onWarning(message):
 	"""Display a warning message."""
-	sys.stderr.write(f"WARNING: {message}\n")
+	write_message(f"WARNING: {message}\n")
 
 
 def onInfo(message):
 	"""Display an information message."""
-	sys.stderr.write(f"INFO: {message}\n")
+	write_message(f"INFO: {message}\n")
 
 
 DEPRECATED = []
 def onDeprecated(msg):
 	"""Display a deprecated message with the given message."""
 	if msg not in DEPRECATED:
-		sys.stderr.write(f"DEPRECATED: {msg}\n")
+		write_message(f"DEPRECATED: {msg}\n")
 		DEPRECATED.append(msg)
 
 
+MODULES = {}
+MODULES_LOCK = threading.RLock()
+
 def loadModule(name, paths):
 	"""Load a module by its name and a collection of paths to look in
-	and return its object. Raises ThotException in case of error."""
+	and return its object. Raises ThotException in case of error.
+	A module file is only executed once per process (and again if
+	it is modified): next loads return the same module object. Hence
+	the global variables of a module are shared by all the documents
+	(possibly processed in parallel): per-document state has to be
+	stored in the document, in the nodes or with Manager.set_info()."""
 	try:
 		for path in paths.split(":"):
 			path = os.path.join(path, name + ".py")
 			if os.path.exists(path):
-				spec = importlib.util.spec_from_file_location(name, path)
-				module = importlib.util.module_from_spec(spec)
-				spec.loader.exec_module(module)
+				rpath = os.path.realpath(path)
+				mtime = os.stat(rpath).st_mtime
+				with MODULES_LOCK:
+					try:
+						date, module = MODULES[rpath]
+						if date == mtime:
+							return module
+					except KeyError:
+						pass
+					spec = importlib.util.spec_from_file_location(name, path)
+					module = importlib.util.module_from_spec(spec)
+					spec.loader.exec_module(module)
+					MODULES[rpath] = (mtime, module)
 				return module
 		return None
 	except Exception as e:
 		onVerbose(lambda _: show_stack())
 		raise ThotException(f"cannot open module '{path}': {e}")
 
+
 AUTHOR_RE = re.compile(r'(.*)\<([^>]*)\>\s*')
 def scanAuthors(text):
 	"""Scan the author text to get structured representation of authors.
@@ -194,6 +224,8 @@ def getLinuxDistrib():
 		return ("", 0)
 
 
+REQUIREMENT_LOCK = threading.Lock()
+
 class CommandRequirement:
 	"""Implements facilities for test for the existence of a command."""
 	checked = False
@@ -208,11 +240,12 @@ class CommandRequirement:
 		self.error = error
 
 	def get(self):
-		if not self.checked:
-			self.checked = True
-			self.path = which(self.cmd)
-			if not self.path:
-				self.error(self.msg)
+		with REQUIREMENT_LOCK:
+			if not self.checked:
+				self.path = which(self.cmd)
+				self.checked = True
+				if not self.path:
+					self.error(self.msg)
 		return self.path
 
 
@@ -422,6 +455,7 @@ class Env:
 
 	VAR_RE = r"@\((?P<varid>[a-zA-Z_0-9]+)\)"
 	VAR_REC = re.compile(VAR_RE)
+	MAX_DEPTH = 16
 
 	def __init__(self, map = None):
 		if map is not None:
@@ -455,15 +489,38 @@ class Env:
 		self.set(key, val)
 
 	def reduce(self, text):
-		"""Reduce variables in the given text.
-		- doc -- current document
+		"""Reduce variables in the given text. Variable values are
+		reduced in turn up to MAX_DEPTH levels. A recursive definition
+		is left as is and warned.
 		- text -- text to replace in."""
-		m = Env.VAR_REC.search(text)
-		while m:
-			val = str(self.get(m.group('varid')))
-			text = text[:m.start()] + val + text[m.end():]
-			m = Env.VAR_REC.search(text)
-		return text
+		if "@(" not in text:
+			return text
+		return self.expand(text, [])
+
+	def expand(self, text, stack):
+		"""Reduce variables in text in one pass. stack is the list of
+		variables currently expanded."""
+		res = []
+		pos = 0
+		for m in Env.VAR_REC.finditer(text):
+			res.append(text[pos:m.start()])
+			pos = m.end()
+			id = m.group('varid')
+			val = str(self.get(id))
+			if "@(" in val:
+				if id in stack:
+					onWarning(f"recursive definition of variable {id}")
+					val = m.group()
+				elif len(stack) >= Env.MAX_DEPTH:
+					onWarning(f"too deep expansion of variable {id}")
+					val = m.group()
+				else:
+					stack.append(id)
+					val = self.expand(val, stack)
+					stack.pop()
+			res.append(val)
+		res.append(text[pos:])
+		return "".join(res)
 
 	def __iter__(self):
 		return iter(self.map)
@@ -277,9 +277,16 @@ class CustomizeEvent(Event):
 
 
 class Info:
+	"""Generic information attached to an object. The dictionary
+	is only allocated when a first information is set."""
 	LABELS = "thot:labels"
 
-	info = None
+	__slots__ = ("info", )
+
+	def __new__(cls, *args, **kwargs):
+		self = object.__new__(cls)
+		self.info = None
+		return self
 
 	def setInfo(self, id, val):
 		"""Deprecated."""
@@ -325,16 +332,27 @@ class Node(Info):
 	"""Base definition of document nodes.
 
 	Each time an event is passed to the Node tree, the function onEvent()
-	is called."""
-	file = None
-	line = None
+	is called.
+
+	To save memory, nodes use slots: the attributes are initialized
+	in __new__() so that sub-classes do not need to call
+	Node.__init__()."""
+	__slots__ = ("file", "line")
+
+	def __new__(cls, *args, **kwargs):
+		self = object.__new__(cls)
+		self.info = None
+		self.file = None
+		self.line = None
+		return self
 
 	def __init__(self):
 		pass
 
 	def setFileLine(self, file, line):
-		"""Set file/line information corresponding to the node."""
-		if self.file is None:
+		"""Set file/line information corresponding to the node.
+		Only the first information is recorded."""
+		if self.file is None and self.line is None:
 			self.file = file
 			self.line = line
 
@@ -458,7 +476,7 @@ class Node(Info):
 
 class Container(Node):
 	"""A container is an item containing other items."""
-	content = None
+	__slots__ = ("content", )
 
 	def __init__(self, content = None):
 		Node.__init__(self)
@@ -531,7 +549,7 @@ class Container(Node):
 
 # Word family
 class Word(Node):
-	text = None
+	__slots__ = ("text", )
 
 	def __init__(self, text):
 		Node.__init__(self)
@@ -543,6 +561,17 @@ class Word(Node):
 	def gen(self, gen):
 		gen.genText(self.text)
 
+	def aggregate(self, man, node):
+		"""Plain words following each other are merged in a single word
+		(as the generation of the merged text is the same)."""
+		if type(node) is Word and type(self) is Word \
+		and self.info is None and node.info is None:
+			man.merge_text(self, node.text)
+			man.push(self)
+			return True
+		man.flush_text()
+		return False
+
 	def __str__(self):
 		return f"word({self.text})"
 
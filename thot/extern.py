@@ -18,14 +18,33 @@
 
 import re
 import subprocess
-import sys
 import tempfile
+import threading
 
+from thot import cache
 from thot import common
 from thot import doc
+from thot import jobs
 from thot import tparser
 
 ARG_RE = re.compile(r"[\s]*([\S]+)[\s]*=(.*)")
+COMMAND_LOCK = threading.Lock()
+COMMAND_LOCKS = {}
+NUM_LOCK = threading.Lock()
+
+
+def get_command_lock(name):
+	"""Get the lock protecting the lookup of the command of the external
+	module of the given name: lookups of different commands do not
+	block each other."""
+	with COMMAND_LOCK:
+		try:
+			return COMMAND_LOCKS[name]
+		except KeyError:
+			lock = threading.Lock()
+			COMMAND_LOCKS[name] = lock
+			return lock
+
 
 class ExternalException(Exception):
 
@@ -180,13 +199,14 @@ class ExternalBlock(doc.Block):
 		Enable the execution of post-pass commands. As a default, do nothgin."""
 		pass
 
-	def run(self, cmd, opts, input):
-		"""Run the command. Return True for success, False else."""
+	def run(self, cmd, opts, input, report = True):
+		"""Run the command. Return True for success, False else.
+		If report is False, a failure of the command is not displayed."""
 		try:
-			cmd = f"{cmd} {' '.join(opts)}"
-			common.onVerbose(lambda _: f"CMD: {cmd}")
+			line = f"{cmd} {' '.join(opts)}"
+			common.onVerbose(lambda _: f"CMD: {line}")
 			with subprocess.Popen(
-				cmd,
+				line,
 				stdin = subprocess.PIPE,
 				stdout = subprocess.PIPE,
 				stderr = subprocess.PIPE,
@@ -199,8 +219,9 @@ class ExternalBlock(doc.Block):
 				if not self.meta.cmd:
 					self.meta.cmd = cmd
 				if process.returncode:
-					sys.stderr.write(err.decode('utf-8'))
-					self.onWarning(f"error during \"{cmd}\" call (return code = {process.returncode})")
+					if report:
+						common.write_message(err.decode('utf-8'))
+						self.onWarning(f"error during \"{line}\" call (return code = {process.returncode})")
 					return False
 				else:
 					return True
@@ -208,33 +229,59 @@ class ExternalBlock(doc.Block):
 			self.onError(f'can not process {self.meta.name}: {e}')
 			return False
 
-	def run_command(self, opts, input):
-		"""Run the command to generate the block."""
+	def run_command(self, opts, input, report = True):
+		"""Run the command to generate the block. If report is False,
+		a failure of the command is not displayed."""
 		if self.meta.cmd:
-			return self.run(self.meta.cmd, opts, input)
-		else:
-			i = 0
-			while i < len(self.meta.cmds):
-				res = self.run(self.meta.cmds[i], opts, input)
-				if res:
-					break
-				else:
-					i = i + 1
-			if self.meta.cmd:
-				return res
+			return self.run(self.meta.cmd, opts, input, report)
+		with get_command_lock(self.meta.name):
+			if self.meta.cmd is None:
+				return self.find_command(opts, input, report)
+		if self.meta.cmd:
+			return self.run(self.meta.cmd, opts, input, report)
+		return False
+
+	def find_command(self, opts, input, report = True):
+		"""Look for the command among the commands of the module
+		and run it to generate the block."""
+		i = 0
+		while i < len(self.meta.cmds):
+			res = self.run(self.meta.cmds[i], opts, input, report)
+			if res:
+				break
 			else:
-				self.meta.cmd = ""
-				self.onWarning(f"cannot generate {self.meta.name} block: " +
-					f"none of commands {', '.join(self.meta.cmds)} is available.")
-				return False
+				i = i + 1
+		if self.meta.cmd:
+			return res
+		else:
+			self.meta.cmd = ""
+			self.onWarning(f"cannot generate {self.meta.name} block: " +
+				f"none of commands {', '.join(self.meta.cmds)} is available.")
+			return False
 
 	def make_input(self, input):
 		"""Prepare input. As a default, do nothing."""
 		pass
 
-	def gen(self, gen):
+	def get_cache_key(self, gen):
+		"""Compute the key identifying the output in the cache: depends
+		on the commands, the options, the output type and the text."""
+		return cache.make_key(
+			self.meta.name,
+			"\n".join(self.meta.cmds),
+			" ".join(f"{opt.name}={val}" for (opt, val) in self.args),
+			gen.getType(),
+			self.toText())
+
+	def make_output(self, gen):
+		"""Produce the output file, from the cache or by running the
+		command. Return True in case of success."""
 		if not self.is_ready():
-			return
+			return False
+		files = cache.get_files(gen.doc.env, "extern")
+		key = self.get_cache_key(gen)
+		if files.get(key, self.get_path(gen), self.meta.ext):
+			return True
 		opts = []
 		input = []
 		self.prepare_input(gen, opts, input)
@@ -242,6 +289,18 @@ class ExternalBlock(doc.Block):
 		self.make_options(opts, input)
 		if self.run_command(opts, input):
 			self.finalize_output(gen)
+			files.put(key, self.get_path(gen), self.meta.ext)
+			return True
+		return False
+
+	def prepare_job(self, gen):
+		if not self.is_ready():
+			return None
+		self.get_path(gen)
+		return lambda: self.make_output(gen)
+
+	def gen(self, gen):
+		if jobs.result(gen, self, lambda: self.make_output(gen)):
 			self.gen_output(gen)
 
 	def numbering(self):
@@ -327,6 +386,7 @@ class ExternalModule(tparser.Syntax):
 		try:
 			block = self.make()
 			block.parse_args(match.group(1))
+			self.declare(man, block)
 			tparser.BlockParser(man, block, self.close)
 		except ExternalException as exn:
 			man.error(exn)
@@ -335,6 +395,11 @@ class ExternalModule(tparser.Syntax):
 		"""Build a block for the module."""
 		return self.maker(self)
 
+	def declare(self, man, block):
+		"""Called each time a block is built by the parser. As a default,
+		the command of the block is scheduled to run in parallel."""
+		jobs.register(man, block)
+
 	def test_command(self):
 		"""Look for a command for the block."""
 		pass
@@ -345,6 +410,7 @@ class ExternalModule(tparser.Syntax):
 
 	def new_num(self):
 		"""Return a new unique number."""
-		r = self.count
-		self.count = self.count + 1
+		with NUM_LOCK:
+			r = self.count
+			self.count = self.count + 1
 		return r
@@ -16,11 +16,16 @@
 
 """Thot module generating source content."""
 
+import collections
 import importlib
 import os.path
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 
+from thot import cache
 from thot import doc, common
 
 FEATURE = "highlight:feature"
@@ -28,6 +33,9 @@ FEATURE = "highlight:feature"
 # highlight command class
 
 class Highlight(doc.Feature):
+	"""Feature managing code highlighting with command highlight.
+	The code blocks of a document are highlighted at preparation time
+	with one call of highlight per language (and options)."""
 
 	BACKS = {
 		'html'	: '',
@@ -44,11 +52,14 @@ class Highlight(doc.Feature):
 	}
 	CSS_BACKS = [ 'html', 'xhtml' ]
 	LANGS = []
+	LANGS_LOCK = threading.Lock()
+	langs_checked = False
 
 	unsupported = []
 	unsupported_backs = []
 	checked = False
 	command = None
+	version = None
 
 	@staticmethod
 	def getCommand():
@@ -60,56 +71,91 @@ class Highlight(doc.Feature):
 				common.onWarning("LinuxMint detected. Workaround to find 'highlight' command in /usr/bin/")
 			else:
 				Highlight.command = common.which("highlight")
-				if not command:
+				if not Highlight.command:
 					common.onWarning("no highlight command found: code will not be colored.")
 		return Highlight.command
 
+	@staticmethod
+	def getVersion():
+		"""Get the version of the highlight command (used to identify
+		the cached files)."""
+		if Highlight.version is None:
+			try:
+				ans = subprocess.check_output(f"{Highlight.getCommand()} --version", shell = True)
+				Highlight.version = ans.decode('utf-8').strip().split("\n")[0]
+			except subprocess.CalledProcessError:
+				Highlight.version = ""
+		return Highlight.version
+
+	@staticmethod
+	def getLangs(files, command, version):
+		"""Get the list of languages supported by the highlight command.
+		The list is built once, under LANGS_LOCK, as the documents may
+		be generated in parallel."""
+		with Highlight.LANGS_LOCK:
+			if Highlight.langs_checked:
+				return Highlight.LANGS
+			key = cache.make_key("langs", command, version)
+			ans = files.get_text(key, ".txt")
+			if ans is None:
+				try:
+					ans = subprocess.check_output(f"{command} --list-scripts=langs", shell = True).decode('utf-8')
+					files.put_text(key, ans, ".txt")
+				except subprocess.CalledProcessError:
+					common.onWarning(f"cannot get supported languages from {command}, " +
+							"falling back to default list.")
+			if ans is not None:
+				langs = []
+				for line in ans.split("\n"):
+					try:
+						p = line.index(":")
+						if p >= 0:
+							line = line[p+1:]
+							for w in line.split():
+								if w not in ('(', ')'):
+									langs.append(w)
+					except ValueError:
+						pass
+				Highlight.LANGS = langs
+			Highlight.langs_checked = True
+			return Highlight.LANGS
+
+	@staticmethod
+	def get_feature(doc):
+		feature = doc.get_info(FEATURE)
+		if feature is None:
+			feature = Highlight()
+			doc.set_info(FEATURE, feature)
+			doc.addFeature(feature)
+		return feature
+
+	def __init__(self):
+		self.blocks = []
+		self.results = {}
+
+	def add(self, block):
+		"""Add a code block to highlight."""
+		self.blocks.append(block)
+
 	def prepare(self, gen):
-		gen.doc.set_info(INFO, "highlight")
 		type = gen.getType()
+		self.results = {}
 		command = Highlight.getCommand()
 		if not command:
 			return
+		files = cache.get_files(gen.doc.env, "highlight")
+		version = Highlight.getVersion()
 
 		# parse list of languages
-		try:
-			ans = subprocess.check_output(f"{command} --list-scripts=langs", shell = True).decode('utf-8')
-			Highlight.LANGS = []
-			for line in ans.split("\n"):
-				try:
-					p = line.index(":")
-					if p >= 0:
-						line = line[p+1:]
-						for w in line.split():
-							if w not in ('(', ')'):
-								Highlight.LANGS.append(w)
-				except ValueError:
-					pass
-		except subprocess.CalledProcessError:
-			common.onWarning(f"cannot get supported languages from {command}, " +
-					"falling back to default list.")
+		Highlight.getLangs(files, command, version)
 
 		# build the CSS file
 		if type in Highlight.CSS_BACKS:
 			if not gen.getTemplate().use_listing('highlight'):
 
 				# generate the highlight file
-				try:
-					css = gen.new_resource('highlight/highlight.css')
-					cfd = True
-					if os.name == "nt":
-						cfd = False
-					process = subprocess.Popen(
-						[f'{command} -f --syntax=c --style-outfile={css}'],
-						stdin = subprocess.PIPE,
-						stdout = subprocess.PIPE,
-						close_fds = cfd,
-						shell = True
-					)
-					_ = process.communicate("")
-				except OSError:
-					sys.stderr.write("ERROR: can not call 'highlight'\n")
-					sys.exit(1)
+				css = gen.new_resource('highlight/highlight.css')
+				self.make_style(files, command, version, css, Highlight.BACKS[type], ".css")
 
 				# add the file to the style
 				styles = gen.doc.getVar('HTML_STYLES')
@@ -120,19 +166,8 @@ class Highlight(doc.Feature):
 
 		# build .sty
 		if type == 'latex':
-			try:
-				css = gen.new_resource('highlight/highlight.sty')
-				process = subprocess.Popen(
-					[f'{command} -f --syntax=c --style-outfile={css} {BACKS[type]}'],
-					stdin = subprocess.PIPE,
-					stdout = subprocess.PIPE,
-					close_fds = True,
-					shell = True
-				)
-				_ = process.communicate("")
-			except OSError:
-				sys.stderr.write("ERROR: can not call 'highlight'\n")
-				sys.exit(1)
+			css = gen.new_resource('highlight/highlight.sty')
+			self.make_style(files, command, version, css, Highlight.BACKS[type], ".sty")
 
 			# build the preamble
 			preamble = gen.doc.getVar('LATEX_PREAMBLE')
@@ -141,6 +176,72 @@ class Highlight(doc.Feature):
 			preamble += '\\input {%s}\n' % gen.get_resource_path(css)
 			gen.doc.setVar('LATEX_PREAMBLE', preamble)
 
+		# highlight the code blocks
+		if type in Highlight.BACKS:
+			self.highlight_all(gen, command)
+
+	def make_style(self, files, command, version, path, opts, ext):
+		"""Build the style file at path, if possible from the cache."""
+		key = cache.make_key("style", command, version, opts)
+		if files.get(key, path, ext):
+			return
+		try:
+			cfd = True
+			if os.name == "nt":
+				cfd = False
+			process = subprocess.Popen(
+				[f'{command} -f --syntax=c --style-outfile={path} {opts}'],
+				stdin = subprocess.PIPE,
+				stdout = subprocess.PIPE,
+				close_fds = cfd,
+				shell = True
+			)
+			_ = process.communicate(b"")
+			files.put(key, path, ext)
+		except OSError:
+			sys.stderr.write("ERROR: can not call 'highlight'\n")
+			sys.exit(1)
+
+	def highlight_all(self, gen, command):
+		"""Highlight the code blocks with one call to highlight for
+		each group of blocks with the same options. Each block is passed
+		in its own file to avoid any interference between blocks."""
+		groups = {}
+		for block in self.blocks:
+			if block.lang in Highlight.LANGS:
+				groups.setdefault(block.get_options(gen), []).append(block)
+		for (opts, blocks) in groups.items():
+			dir = tempfile.mkdtemp(prefix = "thot-highlight-")
+			try:
+				paths = []
+				for (i, block) in enumerate(blocks):
+					path = os.path.join(dir, f"code-{i}")
+					with open(path, "w", encoding="utf8") as out:
+						out.write(block.get_text())
+					paths.append(path)
+				outdir = os.path.join(dir, "out")
+				os.mkdir(outdir)
+				common.onVerbose(lambda _: f"CMD: {command} {opts} ({len(paths)} files)")
+				subprocess.run(
+					f'{command} {opts} -O {outdir} {" ".join(paths)}',
+					stdin = subprocess.DEVNULL,
+					stdout = subprocess.DEVNULL,
+					close_fds = os.name != "nt",
+					shell = True,
+					check = False
+				)
+
+				# split back the results
+				for name in os.listdir(outdir):
+					base = name.split(".")[0]
+					if base.startswith("code-"):
+						with open(os.path.join(outdir, name), encoding="utf8") as input:
+							self.results[blocks[int(base[5:])]] = input.read()
+			except OSError as e:
+				common.onWarning(f"error during call of 'highlight': {e}")
+			finally:
+				shutil.rmtree(dir, ignore_errors = True)
+
 
 class HighlightCodeBlock(doc.Block):
 	lang = None
@@ -150,20 +251,18 @@ class HighlightCodeBlock(doc.Block):
 		doc.Block.__init__(self, "code")
 		self.lang = lang
 		self.line_number = line
-		man.doc.addFeature(HighlightCodeBlock.feature)
+		self.feature = Highlight.get_feature(man.doc)
+		self.feature.add(self)
 		self.set_info(doc.INFO_HTML_CLASSES, ["listing"])
 
 	def dumpHead(self, out, tab):
 		out.write(tab + "code(" + self.lang + ",\n")
 
-	def gen(self, gen):
+	def get_text(self):
+		return "\n".join(self.content)
 
-		# aggregate code
-		text = ""
-		for line in self.content:
-			if text != "":
-				text += '\n'
-			text += line
+	def gen(self, gen):
+		text = self.get_text()
 
 		# generate the code
 		type = gen.getType()
@@ -179,8 +278,8 @@ class HighlightCodeBlock(doc.Block):
 			gen.genEmbeddedEnd(self)
 		elif type == 'docbook':
 			gen.genVerbatim('<programlisting xml:space="preserve" ')
-			if self.lang in DOCBOOK_LANGS:
-				gen.genVerbatim(f' language="{DOCBOOK_LANGS[self.lang]}"')
+			if self.lang in Highlight.DOCBOOK_LANGS:
+				gen.genVerbatim(f' language="{Highlight.DOCBOOK_LANGS[self.lang]}"')
 			gen.genVerbatim('>\n')
 			gen.genText(self.toText())
 			gen.genVerbatim('</programlisting>\n')
@@ -193,6 +292,15 @@ class HighlightCodeBlock(doc.Block):
 		else:
 			return None
 
+	def get_options(self, gen):
+		"""Get the options of the highlight command for this block."""
+		opts = f"-f --syntax={self.lang} {Highlight.BACKS[gen.getType()]}"
+		if self.line_number is not None:
+			opts = opts + " -l"
+			if self.line_number != 1:
+				opts = f"{opts} -m {self.line_number}"
+		return opts
+
 	def genCode(self, gen, text):
 		"""Generate colorized code.
 		gen -- back-end generator
@@ -208,12 +316,12 @@ class HighlightCodeBlock(doc.Block):
 				self.gen_asis(gen, text)
 				return
 
-			# other options
-			opts = ""
-			if self.line_number is not None:
-				opts = opts + " -l"
-				if self.line_number != 1:
-					opts = f"{opts} -m {line}"
+			# already highlighted
+			try:
+				gen.genVerbatim(self.feature.results[self])
+				return
+			except KeyError:
+				pass
 
 			# perform the command
 			try:
@@ -221,7 +329,7 @@ class HighlightCodeBlock(doc.Block):
 				if os.name == "nt":
 					cfd = False
 				process = subprocess.Popen(
-					[f'{command} -f --syntax={self.lang} {Highlight.BACKS[type]} {opts}'],
+					[f'{command} {self.get_options(gen)}'],
 					stdin = subprocess.PIPE,
 					stdout = subprocess.PIPE,
 					close_fds = cfd,
@@ -236,11 +344,11 @@ class HighlightCodeBlock(doc.Block):
 				gen.error("error during call of 'highlight'\n")
 		else:
 			if self.lang and self.lang not in Highlight.LANGS and self.lang not in Highlight.unsupported:
-				gen.warn(f"{lang} unsupported highglight language")
-				Highlight.unsupported.append(lang)
-			if gen.getType() not in Highlight.BACKS and gen.getType() not in Highlight.unsupported_backs:
-				gen.warn(f"{gen.getType()} unsupported highlight back-end")
-				Highlight.unsupported.append(lang)
+				gen.warn(f"{self.lang} unsupported highglight language")
+				Highlight.unsupported.append(self.lang)
+			if type not in Highlight.BACKS and type not in Highlight.unsupported_backs:
+				gen.warn(f"{type} unsupported highlight back-end")
+				Highlight.unsupported_backs.append(type)
 			self.gen_asis(gen, text)
 
 	def gen_asis(self, gen, text):
@@ -250,7 +358,7 @@ class HighlightCodeBlock(doc.Block):
 			gen.genText(text)
 		elif type == 'latex':
 			gen.genVerbatim("\\begin{verbatim}\n")
-			gen.genTex(text)
+			gen.genVerbatim(text)
 			gen.genVerbatim("\n\\end{verbatim}\n")
 		else:
 			gen.genVerbatim(text)
@@ -275,15 +383,23 @@ class PygmentBackend:
 		if lexer is None:
 			self.gen_raw(gen, code)
 		else:
-			class Out:
-				def write(self, text):
-					gen.genVerbatim(text)
 			opts = {}
 			if code.line_number:
 				opts["linenos"] = True
 				opts["linenostart"] = code.line_number
-			formatter = self.formatter(**opts)
-			Pygments.MAIN.highlight(code.get_text(), lexer, formatter, Out())
+			gen.genVerbatim(self.feature.highlight(gen, code, lexer, self.get_formatter(opts)))
+
+	def get_formatter(self, opts):
+		"""Get a formatter for the given options. Formatters are shared
+		by all the code blocks with the same options."""
+		key = (self.formatter, tuple(sorted(opts.items())))
+		with Pygments.LOCK:
+			try:
+				return Pygments.FORMATTERS[key]
+			except KeyError:
+				formatter = self.formatter(**opts)
+				Pygments.FORMATTERS[key] = formatter
+				return formatter
 
 	def gen_raw(self, gen, code):
 		"""Generate raw code."""
@@ -316,7 +432,7 @@ class PygmentsHTML(PygmentBackend):
 			# generate the highlight file
 			css = gen.new_resource('highlight/highlight.css')
 			with open(css, "w") as out:
-				out.write(self.formatter().get_style_defs('.highlight'))
+				out.write(self.get_formatter({}).get_style_defs('.highlight'))
 
 			# add the file to the style
 			styles = gen.doc.getVar('HTML_STYLES')
@@ -344,7 +460,7 @@ class PygmentsLatex(PygmentBackend):
 		# build style file
 		css = gen.new_resource('highlight/highlight.sty')
 		with open(css, "w") as out:
-			out.write(self.formatter().get_style_defs('.highlight'))
+			out.write(self.get_formatter({}).get_style_defs('.highlight'))
 
 		# build the preamble
 		preamble = gen.doc.getVar('LATEX_PREAMBLE')
@@ -383,7 +499,13 @@ class PygmentsDocBook(PygmentBackend):
 
 
 class Pygments(doc.Feature):
-	"""Feature managing code highlighting with module pygments."""
+	"""Feature managing code highlighting with module pygments.
+
+	The highlighted code is memoized in an in-memory LRU of at most
+	FRAGMENTS_SIZE entries, shared by all documents of the process
+	(thot-view re-uses it across page reloads), and stored on disk in the
+	"pygments" cache (unless the caches are disabled). The shared tables
+	are protected by LOCK as documents may be generated in parallel."""
 
 	BACK_MAP = {
 		"html":		PygmentsHTML,
@@ -394,6 +516,11 @@ class Pygments(doc.Feature):
 	LEX = None
 	FORM = None
 	UTIL = None
+	LEXERS = {}
+	FORMATTERS = {}
+	FRAGMENTS = collections.OrderedDict()
+	FRAGMENTS_SIZE = 1024
+	LOCK = threading.Lock()
 
 	@staticmethod
 	def init():
@@ -419,11 +546,6 @@ class Pygments(doc.Feature):
 	def __init__(self):
 		self.backend = None
 
-		# link library
-
-		# record information
-		self.lexer_map = {}
-
 	def prepare(self, gen):
 		type = gen.getType()
 		try:
@@ -434,15 +556,44 @@ class Pygments(doc.Feature):
 
 	def get_lexer(self, lang):
 		"""Get the lexer for the asked lang. Reurn None if lang is not found."""
-		try:
-			return self.lexer_map[lang]
-		except KeyError:
+		with Pygments.LOCK:
+			try:
+				return Pygments.LEXERS[lang]
+			except KeyError:
+				try:
+					lexer = Pygments.LEX.get_lexer_by_name(lang)
+				except Pygments.UTIL.ClassNotFound:
+					lexer = None
+				Pygments.LEXERS[lang] = lexer
+				return lexer
+
+	def highlight(self, gen, code, lexer, formatter):
+		"""Highlight the code with the lexer and the formatter, possibly
+		from the memoized fragments."""
+		text = code.get_text()
+		key = cache.make_key(
+			Pygments.MAIN.__version__,
+			code.lang,
+			type(formatter).__name__,
+			repr(sorted(formatter.options.items())),
+			text)
+		with Pygments.LOCK:
 			try:
-				lexer = Pygments.LEX.get_lexer_by_name(lang)
-			except Pygments.UTIL.ClassNotFound:
-				lexer = None
-			self.lexer_map[lang] = lexer
-			return lexer
+				res = Pygments.FRAGMENTS[key]
+				Pygments.FRAGMENTS.move_to_end(key)
+				return res
+			except KeyError:
+				pass
+		files = cache.get_files(gen.doc.env, "pygments")
+		res = files.get_text(key, ".txt")
+		if res is None:
+			res = Pygments.MAIN.highlight(text, lexer, formatter)
+			files.put_text(key, res, ".txt")
+		with Pygments.LOCK:
+			Pygments.FRAGMENTS[key] = res
+			if len(Pygments.FRAGMENTS) > Pygments.FRAGMENTS_SIZE:
+				Pygments.FRAGMENTS.popitem(last = False)
+		return res
 
 	def gen(self, gen, code):
 		"""Generates the passed code."""
@@ -478,7 +629,6 @@ class PygmentsCodeBlock(doc.Block):
 if Pygments.init():
 	CodeBlock = PygmentsCodeBlock
 else:
-	HighlightCodeBlock.feature = Highlight()
 	CodeBlock = HighlightCodeBlock
 
 
@@ -0,0 +1,110 @@
+# jobs -- parallel execution of external tools
+# Copyright (C) 2024  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Parallel execution of the external tools used by the nodes of
+a document.
+
+A node that runs an external tool is registered with register() while
+parsing. During Document.pregen(), the scheduler calls prepare_job(gen)
+on each registered node: it must return a function performing the job
+(or None). The jobs run concurrently on WORKERS threads and, in its gen()
+function, the node retrieves the result of its job with result().
+
+The messages displayed by a job (through common.write_message(), as
+Node.onError() or Node.onWarning() do) are recorded and displayed
+when the result is retrieved, that is, in the order of the document."""
+
+import concurrent.futures
+import os
+import sys
+
+from thot import common
+from thot import doc
+
+WORKERS = os.cpu_count() or 1
+INFO_SCHEDULER = "thot:scheduler"
+
+
+def run(job):
+	"""Run a job in a worker and record its messages. Return the triple
+	(messages, result, exception)."""
+	common.MESSAGES.list = []
+	res = None
+	exn = None
+	try:
+		res = job()
+	except BaseException as e:
+		exn = e
+	messages = common.MESSAGES.list
+	common.MESSAGES.list = None
+	return messages, res, exn
+
+
+class Scheduler(doc.Feature):
+	"""Feature running the jobs of the registered nodes."""
+
+	def __init__(self):
+		self.nodes = []
+		self.futures = {}
+
+	def add(self, node):
+		"""Add a node having a job."""
+		self.nodes.append(node)
+
+	def prepare(self, gen):
+		self.futures = {}
+		if WORKERS <= 1:
+			return
+		with concurrent.futures.ThreadPoolExecutor(WORKERS) as pool:
+			for node in self.nodes:
+				job = node.prepare_job(gen)
+				if job is not None:
+					self.futures[node] = pool.submit(run, job)
+
+	def take(self, node):
+		"""Get the future of the job of the node. Return None if the
+		job has not been launched."""
+		return self.futures.pop(node, None)
+
+	def __getstate__(self):
+		return {"nodes": self.nodes, "futures": {}}
+
+
+def register(man, node):
+	"""Register a node having a job in the document of the manager."""
+	sched = man.doc.get_info(INFO_SCHEDULER)
+	if sched is None:
+		sched = Scheduler()
+		man.doc.set_info(INFO_SCHEDULER, sched)
+		man.doc.addFeature(sched)
+	sched.add(node)
+
+
+def result(gen, node, job):
+	"""Get the result of the job of the node: if the job has been run
+	by the scheduler, return its result (exceptions raised by the job are
+	raised again here). Else run the job now."""
+	sched = gen.doc.get_info(INFO_SCHEDULER)
+	if sched is not None:
+		future = sched.take(node)
+		if future is not None:
+			messages, res, exn = future.result()
+			for message in messages:
+				sys.stderr.write(message)
+			if exn is not None:
+				raise exn
+			return res
+	return job()
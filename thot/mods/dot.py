@@ -16,20 +16,23 @@
 
 """Module supporting block with .dot graph code."""
 
+import itertools
 import re
 import subprocess
-import sys
 
+from thot import cache
 from thot import common
 from thot import doc
+from thot import jobs
 from thot import tparser
 
-count = 0
+count = itertools.count()
 
 class DotBlock(doc.Block):
 	"""A block containing .dot graph.
 	See http://www.graphviz.org/ for more details."""
 	kind = None
+	path = None
 
 	def __init__(self, kind):
 		doc.Block.__init__(self, "dot")
@@ -41,12 +44,23 @@ class DotBlock(doc.Block):
 	def dumpHead(self, out, tab):
 		out.write(f"{tab}block.dot(\n")
 
-	def gen(self, gen):
-		global count
-		path = gen.new_resource(f'dot/graph-{count}.png')
+	def get_path(self, gen):
+		"""Get the path of the generated image."""
+		if self.path is None:
+			self.path = gen.new_resource(f'dot/graph-{next(count)}.png')
+		return self.path
+
+	def make_output(self, gen):
+		"""Produce the image, from the cache or by running dot.
+		Return True if the figure can be generated."""
+		path = self.get_path(gen)
+		text = self.toText()
+		files = cache.get_files(gen.doc.env, "extern")
+		key = cache.make_key("dot", self.kind, "png", text)
+		if files.get(key, path, ".png"):
+			return True
 		cmd = f'{self.kind} -Tpng -o {path}'
 		common.onVerbose(lambda _: f"CMD: {cmd}")
-		count += 1
 		try:
 			process = subprocess.Popen(
 				[cmd],
@@ -57,16 +71,25 @@ class DotBlock(doc.Block):
 					shell = True,
 					encoding='utf8'
 				)
-			text = self.toText()
 			(_, err) = process.communicate(text)
 			if process.returncode != 0:
-				sys.stderr.write(err)
+				common.write_message(err)
 				self.onError(f'error during dot call on {text}')
 			if err:
 				self.onError(f'error during dot call: {err} on {text}')
-			gen.genFigure(path, self, self.get_caption())
+			files.put(key, path, ".png")
+			return True
 		except OSError as e:
 			self.onError(f'can not process dot graph: {e}')
+			return False
+
+	def prepare_job(self, gen):
+		self.get_path(gen)
+		return lambda: self.make_output(gen)
+
+	def gen(self, gen):
+		if jobs.result(gen, self, lambda: self.make_output(gen)):
+			gen.genFigure(self.get_path(gen), self, self.get_caption())
 
 	def getKind(self):
 		return "figure"
@@ -82,11 +105,15 @@ DOT_CLOSE = re.compile("^</dot>")
 DOT_CLOSE_OLD = re.compile("^@</dot>")
 
 def handleDot(man, match):
-	tparser.BlockParser(man, DotBlock(match.group(2)), DOT_CLOSE)
+	block = DotBlock(match.group(2))
+	jobs.register(man, block)
+	tparser.BlockParser(man, block, DOT_CLOSE)
 
 def handleDotOld(man, match):
 	common.onDeprecated("@<dot> form is now deprecated. Use <dot> instead.")
-	tparser.BlockParser(man, DotBlock(match.group(2)), DOT_CLOSE_OLD)
+	block = DotBlock(match.group(2))
+	jobs.register(man, block)
+	tparser.BlockParser(man, block, DOT_CLOSE_OLD)
 
 __short__ = "Import GrahViz Dot in THOT output."
 __desdcription__ = __short__ + """
@@ -108,6 +108,7 @@ class Source:
 def handle_use(man, match):
 	options = common.parse_options(man, match.group("options"),
 		[("sep", "."), ("ref", None)])
+	man.add_input(match.group("path"))
 	man.doxygen.add_use(match.group("path"), options["sep"], options["ref"])
 
 def handle_prefix(man, match):
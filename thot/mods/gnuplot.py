@@ -16,14 +16,17 @@
 
 """Module supporting generation of output with gnuplot."""
 
+import itertools
 import re
 import subprocess
-import sys
 
+from thot import cache
+from thot import common
 from thot import doc
+from thot import jobs
 from thot import tparser
 
-count = 0
+count = itertools.count()
 has_gnuplot = True
 
 class GnuPlotBlock(doc.Block):
@@ -31,6 +34,7 @@ class GnuPlotBlock(doc.Block):
 	See http://gnuplot.info/ for more details."""
 	w = None
 	h = None
+	path = None
 
 	def __init__(self, w, h):
 		doc.Block.__init__(self, "gnuplot")
@@ -40,13 +44,18 @@ class GnuPlotBlock(doc.Block):
 	def dumpHead(self, out, tab):
 		out.write(f"{tab}sblock.gnuplot(\n")
 
-	def gen(self, gen):
+	def get_path(self, gen):
+		"""Get the path of the generated image."""
+		if self.path is None:
+			self.path = gen.new_resource(f'gnuplot/graph-{next(count)}.png')
+		return self.path
 
-		# gnuplot exists ?
-		global count
+	def make_output(self, gen):
+		"""Produce the image, from the cache or by running gnuplot.
+		Return True if the figure can be generated."""
 		global has_gnuplot
 		if not has_gnuplot:
-			return
+			return False
 
 		# prepare the size
 		opt = ""
@@ -55,8 +64,12 @@ class GnuPlotBlock(doc.Block):
 				self.h = self.w
 			opt = f"size {self.w},{self.h}"
 
-		path = gen.new_resource(f'gnuplot/graph-{count}.png')
-		count += 1
+		path = self.get_path(gen)
+		text = self.toText()
+		files = cache.get_files(gen.doc.env, "extern")
+		key = cache.make_key("gnuplot", opt, "png", text)
+		if files.get(key, path, ".png"):
+			return True
 		try:
 			process = subprocess.Popen(
 				[ 'gnuplot' ],
@@ -67,20 +80,34 @@ class GnuPlotBlock(doc.Block):
 					shell = True
 				)
 			(_, err) = process.communicate(("set terminal png transparent " +
-				f"{opt} crop\nset output \"{path}\"\n{self.toText()}").encode('utf-8'))
+				f"{opt} crop\nset output \"{path}\"\n{text}").encode('utf-8'))
 			if process.returncode == 127:
-				has_gnuplot = False
-				self.onWarning("gnuplot is not available")
-				return
+				if has_gnuplot:
+					has_gnuplot = False
+					self.onWarning("gnuplot is not available")
+				return False
 			if process.returncode:
-				print(f"ERROR: {process.returncode}")
-				sys.stderr.write(err.decode('utf-8'))
+				common.write_message(f"ERROR: {process.returncode}\n")
+				common.write_message(err.decode('utf-8'))
 				self.onError('error during gnuplot call')
-			gen.genEmbeddedBegin(self)
-			gen.genImage(path, self, self.get_caption())
-			gen.genEmbeddedEnd(self)
+			else:
+				files.put(key, path, ".png")
+			return True
 		except OSError as e:
 			self.onError(f'can not process gnuplot: {e}')
+			return False
+
+	def prepare_job(self, gen):
+		if not has_gnuplot:
+			return None
+		self.get_path(gen)
+		return lambda: self.make_output(gen)
+
+	def gen(self, gen):
+		if jobs.result(gen, self, lambda: self.make_output(gen)):
+			gen.genEmbeddedBegin(self)
+			gen.genImage(self.get_path(gen), self, self.get_caption())
+			gen.genEmbeddedEnd(self)
 
 	def numbering(self):
 		if self.get_caption() or self.get_labels():
@@ -92,7 +119,9 @@ class GnuPlotBlock(doc.Block):
 GNUPLOT_CLOSE = re.compile("^</gnuplot>")
 
 def handleGnuPlot(man, match):
-	tparser.BlockParser(man, GnuPlotBlock(match.group(2), match.group(4)), GNUPLOT_CLOSE)
+	block = GnuPlotBlock(match.group(2), match.group(4))
+	jobs.register(man, block)
+	tparser.BlockParser(man, block, GNUPLOT_CLOSE)
 
 GNUPLOT_OPEN = (handleGnuPlot, re.compile(r"^<gnuplot(\?([0-9]+)(x([0-9]+)))?>"))
 
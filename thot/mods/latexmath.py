@@ -16,18 +16,34 @@
 
 """Module for syntax for including Latex math."""
 
+import html
+import importlib.metadata
+import itertools
 import re
 import subprocess
 import sys
+import threading
 
-from thot import common, doc, tparser
+from thot import cache, common, doc, jobs, tparser
 
-count = 0
-formulae = { }
+count = itertools.count()
+
+# Conversions of latex2mathml, shared by all the documents.
+MEMO = {}
+MEMO_LOCK = threading.Lock()
 
 class Builder(doc.Feature):
 	"""Builder for math expression and feature"""
 
+	def declare(self, man, node):
+		"""Called when a formula node is created."""
+		pass
+
+	def prepare_job(self, gen, node, texts):
+		"""Called to get the job preparing the given formulae of the node
+		(see module jobs). As a default, return None."""
+		return None
+
 	def genWord(self, man, w):
 		"""Generate the HTML for a word formula."""
 		pass
@@ -70,6 +86,9 @@ class MathWord(doc.Word):
 	def dump(self, out=sys.stdout, tab = ""):
 		out.write(f"{tab}latexmath({self.text})\n")
 
+	def prepare_job(self, gen):
+		return self.builder.prepare_job(gen, self, [self.text])
+
 	def gen(self, gen):
 		if gen.getType() == "latex":
 			gen.genVerbatim(f"${self.text}$")
@@ -94,6 +113,9 @@ class MathBlock(doc.Block):
 	def numbering(self):
 		return "equation"
 
+	def prepare_job(self, gen):
+		return self.builder.prepare_job(gen, self, self.content)
+
 	def gen(self, gen):
 
 		if gen.getType() == "latex":
@@ -116,12 +138,38 @@ class MathBlock(doc.Block):
 
 
 class L2MLBuilder(Builder):
+	"""Builder using latex2mathml: the formulae are converted to MathML
+	at generation time and the page does not need any script to display
+	them. The conversions are memoized for the life of the process and
+	stored in the "latexmath" cache."""
 
-	def __init__(self, f):
+	def __init__(self, f, version = ""):
 		self.f = f
+		self.version = version
+
+	def convert(self, gen, node, text):
+		"""Convert the formula to MathML."""
+		with MEMO_LOCK:
+			try:
+				return MEMO[text]
+			except KeyError:
+				pass
+		files = cache.get_files(gen.doc.env, "latexmath")
+		key = cache.make_key("latex2mathml", self.version, text)
+		res = files.get_text(key, ".xml")
+		if res is None:
+			try:
+				res = self.f(text)
+			except Exception as e:
+				node.onWarning(f"bad latexmath formula: {text} ({type(e).__name__})")
+				return html.escape(text)
+			files.put_text(key, res, ".xml")
+		with MEMO_LOCK:
+			MEMO[text] = res
+		return res
 
 	def genWord(self, man, w):
-		man.genVerbatim(self.f(w.text))
+		man.genVerbatim(self.convert(man, w, w.text))
 
 	def genBlock(self, man, b):
 		man.genOpenTag("center")
@@ -131,7 +179,7 @@ class L2MLBuilder(Builder):
 				f = False
 			else:
 				man.genVerbatim("<br/>")
-			man.genVerbatim(self.f(line))
+			man.genVerbatim(self.convert(man, b, line))
 		man.genCloseTag("center")
 
 
@@ -162,90 +210,98 @@ class MathJAXBuilder(Builder):
 		man.genVerbatim("$$")
 
 
-class MimetexMath(doc.Word):
-
-	def __init__(self, text):
-		doc.Word.__init__(self, text)
-
-	def dump(self, out=sys.stdout, tab = ""):
-		out.write(f"{tab}latexmath({self.text})\n")
-
-	def prepare(self, man):
-		pass
-
-	def gen(self, gen):
-		global count
-
-		if gen.getType() == "latex":
-			gen.genVerbatim(f"${self.text}$")
-		else:
-			cmd = mimetex.get()
-			if not cmd:
-				return
-			rpath = ''
-			if self.text in formulae:
-				rpath = formulae[self.text]
-			else:
-				rpath = gen.new_friend(f"latexmath/latexmath-{count}.gif")
-				count += 1
-				try:
-					proc = subprocess.Popen(
-						[f"{cmd} -d '{self.text}' -e {rpath}"],
-						stdout = subprocess.PIPE,
-						stderr = subprocess.PIPE,
-						shell = True
-					)
-					out, err = proc.communicate()
-					if proc.returncode != 0:
-						sys.stderr.write(out)
-						sys.stderr.write(err)
-						self.onWarning("bad latexmath formula.")
-					else:
-						formulae[self.text] = rpath
-				except OSError:
-					#MIMETEX_AVAILABLE = False
-					self.onWarning("mimetex is not available: no latexmath !")
-			if rpath:
-				gen.genImage(rpath, None, self)
-
 class MimetexBuilder(Builder):
+	"""Builder producing images with mimetex. The images are stored in
+	the "latexmath" cache and the missing ones are produced in parallel
+	(see module jobs). The paths of the formulae images are specific
+	to the document of the builder."""
+
+	def __init__(self):
+		self.formulae = { }
+		self.made = { }
+		self.locks = { }
+		self.lock = threading.Lock()
+
+	def __reduce__(self):
+		return (MimetexBuilder, ())
+
+	def declare(self, man, node):
+		jobs.register(man, node)
+
+	def get_path(self, gen, text):
+		"""Get the path of the image of the formula."""
+		with self.lock:
+			try:
+				return self.formulae[text]
+			except KeyError:
+				rpath = gen.new_resource(f"latexmath/latexmath-{next(count)}.gif")
+				self.formulae[text] = rpath
+				return rpath
+
+	def build(self, gen, cmd, text, rpath, node):
+		"""Make the image of the formula if not already done (possibly
+		by another thread). Return True for success."""
+		with self.lock:
+			lock = self.locks.setdefault(text, threading.Lock())
+		with lock:
+			if text not in self.made:
+				self.made[text] = self.make(gen, cmd, text, rpath, node)
+			return self.made[text]
+
+	def prepare_job(self, gen, node, texts):
+		cmd = mimetex.get()
+		if not cmd:
+			return None
+		todo = []
+		for text in texts:
+			if text not in self.made and text not in self.formulae:
+				todo.append((text, self.get_path(gen, text)))
+		if not todo:
+			return None
+		def job():
+			for (text, rpath) in todo:
+				self.build(gen, cmd, text, rpath, node)
+		return job
+
+	def make(self, gen, cmd, text, rpath, node):
+		"""Produce the image of the formula. Return True for success."""
+		files = cache.get_files(gen.doc.env, "latexmath")
+		key = cache.make_key("mimetex", cmd, text)
+		if files.get(key, rpath, ".gif"):
+			return True
+		try:
+			proc = subprocess.Popen(
+				[f"{cmd} -d '{text}' -e {rpath}"],
+				stdout = subprocess.PIPE,
+				stderr = subprocess.PIPE,
+				shell = True
+			)
+			out, err = proc.communicate()
+			if proc.returncode != 0:
+				common.write_message(out.decode('utf-8'))
+				common.write_message(err.decode('utf-8'))
+				node.onWarning("bad latexmath formula.")
+				return False
+			files.put(key, rpath, ".gif")
+			return True
+		except OSError:
+			node.onWarning("mimetex is not available: no latexmath !")
+			return False
 
 	def gen(self, gen, text, part):
-		global count
-
 		cmd = mimetex.get()
 		if not cmd:
 			return
-		rpath = ''
-		if text in formulae:
-			rpath = formulae[text]
-		else:
-			rpath = gen.new_resource(f"latexmath/latexmath-{count}.gif")
-			count += 1
-			try:
-				proc = subprocess.Popen(
-					[f"{cmd} -d '{text}' -e {rpath}"],
-					stdout = subprocess.PIPE,
-					stderr = subprocess.PIPE,
-					shell = True
-				)
-				out, err = proc.communicate()
-				if proc.returncode != 0:
-					sys.stderr.write(out)
-					sys.stderr.write(err)
-					self.onWarning("bad latexmath formula.")
-				else:
-					formulae[text] = rpath
-			except OSError:
-				#MIMETEX_AVAILABLE = False
-				gen.onWarning("mimetex is not available: no latexmath !")
-		if rpath:
+		rpath = self.get_path(gen, text)
+		if self.build(gen, cmd, text, rpath, part):
 			gen.genImage(rpath, part, None)
 
 	def genWord(self, man, w):
+		jobs.result(man, w, lambda: None)
 		self.gen(man, w.text, w)
 
 	def genBlock(self, man, b):
+		jobs.result(man, b, lambda: None)
 		man.genOpenTag("center")
 		f = True
 		for line in b.content:
@@ -258,35 +314,50 @@ class MimetexBuilder(Builder):
 
 
 # Alternative management
+# BUILDERS maps the back-end names to functions building a builder:
+# each document has its own builder instance.
 
 DEFAULT = None
 BUILDERS = { }
-BUILDER = None
 
 try:
 	import latex2mathml.converter as m
-	BUILDERS["latex2mathml"] = L2MLBuilder(m.convert)
+	try:
+		l2ml_version = importlib.metadata.version("latex2mathml")
+	except importlib.metadata.PackageNotFoundError:
+		l2ml_version = ""
+	BUILDERS["latex2mathml"] = lambda: L2MLBuilder(m.convert, l2ml_version)
 	DEFAULT = "latex2mathml"
 except ImportError as e:
 	pass
 
-BUILDERS["mathjax"] = MathJAXBuilder()
+BUILDERS["mathjax"] = MathJAXBuilder
 if DEFAULT is None:
 	DEFAULT = "mathjax"
 
 mimetex = common.CommandRequirement("mimetex",
 	'mimetex not found but required by latexmath module: ignoring latexmath tags')
-BUILDERS["mimetex"] = MimetexBuilder()
+BUILDERS["mimetex"] = MimetexBuilder
 if DEFAULT is None:
 	DEFAULT = "mimetex"
 
 def selectBuilder(man):
-	global BUILDER
+	"""Build the builder of the current document."""
+	n = man.doc.getVar("LATEXMATH", DEFAULT)
 	try:
-		n = man.doc.getVar("LATEXMATH", DEFAULT)
-		BUILDER = BUILDERS[n]
+		make = BUILDERS[n]
 	except KeyError as e:
 		man.warn(f"unknown mathlatex output: {e}. Reverting to use mimetex.")
+		make = BUILDERS["mimetex"]
+	man.set_info("latexmath", make())
+
+def getBuilder(man):
+	"""Get the builder of the current document."""
+	builder = man.get_info("latexmath")
+	if builder is None:
+		selectBuilder(man)
+		builder = man.get_info("latexmath")
+	return builder
 
 
 # Syntax
@@ -298,12 +369,18 @@ def handleMath(man, match):
 	if text == "":
 		man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, doc.Word("$")))
 	else:
-		man.doc.addFeature(BUILDER)
-		man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, MathWord(text, BUILDER)))
+		builder = getBuilder(man)
+		man.doc.addFeature(builder)
+		word = MathWord(text, builder)
+		builder.declare(man, word)
+		man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, word))
 
 def handleBlock(man, match):
-	man.doc.addFeature(BUILDER)
-	tparser.BlockParser(man, MathBlock(BUILDER), END_BLOCK)
+	builder = getBuilder(man)
+	man.doc.addFeature(builder)
+	block = MathBlock(builder)
+	builder.declare(man, block)
+	tparser.BlockParser(man, block, END_BLOCK)
 
 
 # module declaration
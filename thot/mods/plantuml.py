@@ -19,21 +19,141 @@
 This module uses either CLASSPATH to find PlantUML, the document variable
 PLANTUML_JAR, or the environment variable PLANTUML_JAR  to retrieve
 the .jar of PlantUML.
+
+All the diagrams of a document are generated by a single call to PlantUML
+(using its multi-file mode) to pay only once the start-up of the JVM.
 """
 
 import os
 import shutil
+import tempfile
+import threading
 
+from thot import cache
 from thot import extern
+from thot import jobs
+
+INFO_BATCH = "plantuml:batch"
+
+
+class Batch:
+	"""Generates the diagrams of a document with one PlantUML process."""
+
+	def __init__(self, meta):
+		self.meta = meta
+		self.blocks = []
+		self.lock = threading.Lock()
+		self.gen = None
+
+	def __getstate__(self):
+		return {"meta": self.meta, "blocks": self.blocks}
+
+	def __setstate__(self, state):
+		self.__init__(state["meta"])
+		self.blocks = state["blocks"]
+
+	def add(self, block):
+		"""Add a block to generate."""
+		self.blocks.append(block)
+		block.batch = self
+
+	def prepare_job(self, gen):
+		for block in self.blocks:
+			block.get_path(gen)
+		return lambda: self.run(gen)
+
+	def run(self, gen):
+		"""Generate the diagrams, only once for the given generator."""
+		with self.lock:
+			if self.gen is not gen:
+				self.gen = gen
+				self.process(gen)
+
+	def process(self, gen):
+		"""Generate the diagrams not found in the cache."""
+		if gen.getType() == "latex":
+			type = "pdf"
+		else:
+			type = "png"
+		files = cache.get_files(gen.doc.env, "extern")
+		todo = []
+		for block in self.blocks:
+			key = block.get_cache_key(gen)
+			block.made = files.get(key, block.get_path(gen), self.meta.ext)
+			if not block.made:
+				todo.append((block, key))
+		if not todo or not self.meta.command_found():
+			return
+
+		# run PlantUML on all diagrams
+		dir = tempfile.mkdtemp(prefix = "thot-plantuml-")
+		try:
+			opts = [f"-t{type}"]
+			for (i, (block, _)) in enumerate(todo):
+				path = os.path.join(dir, f"diagram-{i}.txt")
+				with open(path, "w", encoding="utf8") as out:
+					out.write(block.get_uml())
+				opts.append(path)
+
+			# in case of error, the produced diagrams are kept but not
+			# cached (PlantUML may produce images showing the error) and
+			# the missing ones are generated one by one to report the
+			# error on the faulty block
+			if not todo[0][0].run_command(opts, [], False):
+				if self.meta.command_found():
+					self.recover(gen, dir, type, todo)
+				return
+
+			# dispatch the results
+			for (i, (block, key)) in enumerate(todo):
+				try:
+					shutil.move(os.path.join(dir, f"diagram-{i}.{type}"), block.get_path(gen))
+					files.put(key, block.get_path(gen), self.meta.ext)
+					block.made = True
+				except IOError as e:
+					block.onWarning(f"plantuml error: {e}. Cannot generate plantuml diagram.")
+		finally:
+			shutil.rmtree(dir, ignore_errors = True)
+
+	def recover(self, gen, dir, type, todo):
+		"""Dispatch the diagrams produced by a failed run of PlantUML
+		and generate the missing ones separately."""
+		missing = False
+		for (i, (block, _)) in enumerate(todo):
+			path = os.path.join(dir, f"diagram-{i}.{type}")
+			if os.path.exists(path):
+				try:
+					shutil.move(path, block.get_path(gen))
+					block.made = True
+					continue
+				except IOError:
+					pass
+			missing = True
+			block.made = extern.ExternalBlock.make_output(block, gen)
+		if not missing:
+			todo[0][0].onWarning("plantuml error: see the generated diagrams.")
+
 
 class PlantUMLBlock(extern.ExternalBlock):
+	batch = None
+	made = False
 
 	def __init__(self, meta):
 		extern.ExternalBlock.__init__(self, meta)
 		self.out_path = None
 
+	def get_uml(self):
+		"""Get the PlantUML source of the diagram."""
+		return f"@startuml\n{self.toText()}\n@enduml\n"
+
+	def make_output(self, gen):
+		if self.batch is None:
+			return extern.ExternalBlock.make_output(self, gen)
+		jobs.result(gen, self.batch, lambda: self.batch.run(gen))
+		return self.made
+
 	def prepare_input(self, gen, opts, input):
-		tmp = self.dump_temporary(f"@startuml\n{self.toText()}\n@enduml\n")
+		tmp = self.dump_temporary(self.get_uml())
 		if gen.getType() == "latex":
 			opts.append("-tpdf")
 			self.out_path = tmp[:-4] + ".pdf"
@@ -48,6 +168,19 @@ class PlantUMLBlock(extern.ExternalBlock):
 		except IOError as e:
 			gen.warn("plantuml error: %s. Cannot generate plantuml diagram.", e)
 
+
+class PlantUMLModule(extern.ExternalModule):
+	"""The blocks are not generated one by one but by a batch."""
+
+	def declare(self, man, block):
+		batch = man.doc.get_info(INFO_BATCH)
+		if batch is None:
+			batch = Batch(self)
+			man.doc.set_info(INFO_BATCH, batch)
+			jobs.register(man, batch)
+		batch.add(block)
+
+
 my_cmds = ["java net.sourceforge.plantuml.Run"]
 #jar = man.get_var("PLANTUML_JAR")
 #if jar:
@@ -66,7 +199,7 @@ ASCII text and converted to images by AAfig. The complete documentation
 of AAFig can be found here: https://launchpad.net/aafigure."""
 
 __syntaxes__ = [
-	extern.ExternalModule(
+	PlantUMLModule(
 		name = "plantuml",
 		ext=".png",
 		cmds=my_cmds,
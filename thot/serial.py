@@ -0,0 +1,125 @@
+# serial -- serialization of Thot documents
+# Copyright (C) 2024  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Binary serialization of parsed documents. A serialized document
+contains the node tree (content, words, information), the labels, the
+features and, optionally, the environment of the document.
+
+The format is a magic header followed by a pickle of the document.
+Classes and functions defined in Thot modules (that are not importable
+by name) are stored as references (module path, name) and the module
+is loaded again when the document is read.
+
+Nodes that cannot be serialized as is (because they contain files,
+processes, etc) may register a reduction function with register()."""
+
+import copyreg
+import io
+import os.path
+import pickle
+import types
+
+from thot import common
+from thot import doc
+
+MAGIC = b"THOT-DOC\x01"
+
+REDUCERS = {}
+
+def register(cls, reduce):
+	"""Register a reduction function for objects of class cls. reduce
+	takes the object and returns a pair (callable, arguments) used to
+	re-build the object (as __reduce__ of pickle module)."""
+	REDUCERS[cls] = reduce
+
+
+class Pickler(pickle.Pickler):
+	"""Pickler supporting the classes and functions of the Thot modules
+	and the registered reducers."""
+
+	def __init__(self, file):
+		pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+		if REDUCERS:
+			self.dispatch_table = copyreg.dispatch_table.copy()
+			self.dispatch_table.update(REDUCERS)
+		self.globals = {}
+		for (path, (_, mod)) in common.MODULES.items():
+			self.globals[id(mod)] = (path, None)
+			for (name, val) in mod.__dict__.items():
+				if isinstance(val, (type, types.FunctionType)) \
+				and val.__module__ == mod.__name__:
+					self.globals[id(val)] = (path, name)
+
+	def persistent_id(self, obj):
+		return self.globals.get(id(obj))
+
+
+class Unpickler(pickle.Unpickler):
+	"""Unpickler matching Pickler."""
+
+	def persistent_load(self, pid):
+		path, name = pid
+		mod = common.loadModule(
+			os.path.splitext(os.path.basename(path))[0],
+			os.path.dirname(path))
+		if mod is None:
+			raise pickle.UnpicklingError(f"no module {path}")
+		if name is None:
+			return mod
+		return getattr(mod, name)
+
+
+def dump(document, out, with_env = True):
+	"""Write the given document to the binary stream out.
+	If with_env is False, the environment is not stored."""
+	env = document.env
+	if not with_env:
+		document.env = None
+	try:
+		out.write(MAGIC)
+		Pickler(out).dump((document,
+			doc.Document.labels, doc.Document.inv_labels))
+	finally:
+		document.env = env
+
+
+def load(input, env = None):
+	"""Read a document from the binary stream input. If env is not None,
+	it becomes the environment of the document. Raise
+	common.ThotException if the stream does not contain a document."""
+	if input.read(len(MAGIC)) != MAGIC:
+		raise common.ThotException("not a Thot document")
+	try:
+		document, labels, inv_labels = Unpickler(input).load()
+	except Exception as e:
+		raise common.ThotException(f"cannot read document: {e}")
+	if env is not None:
+		document.env = env
+	doc.Document.labels.update(labels)
+	doc.Document.inv_labels.update(inv_labels)
+	return document
+
+
+def dumps(document, with_env = True):
+	"""Serialize the document as bytes."""
+	out = io.BytesIO()
+	dump(document, out, with_env)
+	return out.getvalue()
+
+
+def loads(data, env = None):
+	"""Build a document from bytes produced by dumps()."""
+	return load(io.BytesIO(data), env)
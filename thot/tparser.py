@@ -18,6 +18,7 @@
 
 import os.path
 import re
+import sys
 
 from thot import doc
 from thot import common
@@ -78,33 +79,62 @@ __words__ = [
 ]
 INITIAL_WORDS = [(f, e) for (f, e, _) in __words__]
 
+WORDS_CACHE = {}
+LINES_CACHE = {}
+RE_CACHE = {}
+
+def compile_words(words):
+	"""Build the combined RE of a list of pairs (function, RE string).
+	The result is shared by all managers using the same word REs."""
+	key = tuple(wre for (_, wre) in words)
+	try:
+		return WORDS_CACHE[key]
+	except KeyError:
+		text = "|".join("(?P<a" + str(i) + ">" + wre + ")"
+			for (i, wre) in enumerate(key))
+		words_re = re.compile(text)
+		WORDS_CACHE[key] = words_re
+		return words_re
+
+def compile_lines(lines):
+	"""Get the line dispatcher of a list of pairs (function, compiled RE).
+	The result is shared by all managers using the same line syntax."""
+	key = tuple(lines)
+	try:
+		return LINES_CACHE[key]
+	except KeyError:
+		disp = LineDispatcher(lines)
+		LINES_CACHE[key] = disp
+		return disp
+
+def compile_re(text):
+	"""Compile a RE string of a module syntax only once."""
+	try:
+		return RE_CACHE[text]
+	except KeyError:
+		line_re = re.compile(text)
+		RE_CACHE[text] = line_re
+		return line_re
+
 def handleText(man, line, suffix = ' '):
 
 	# init RE_WORDS
 	if man.words_re is None:
-		text = ""
-		i = 0
-		for (fun, wre) in man.words:
-			if text != "":
-				text = text + "|"
-			text = text + "(?P<a" + str(i) + ">" + wre + ")"
-			i = i + 1
-		man.words_re = re.compile(text)
-
-	# look in line
-	match = man.words_re.search(line)
-	while match:
-		idx = int(match.lastgroup[1:])
-		fun, wre = man.words[idx]
-		word = line[:match.start()]
-		if word:
-			man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, man.factory.makeWord(word)))
-		line = line[match.end():]
+		man.words_re = compile_words(man.words)
+
+	# look in line (matches are relative to the whole line)
+	words = man.words
+	pos = 0
+	for match in man.words_re.finditer(line):
+		fun, _ = words[int(match.lastgroup[1:])]
+		start = match.start()
+		if start > pos:
+			man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, man.factory.makeWord(line[pos:start])))
+		pos = match.end()
 		fun(man, match)
-		match = man.words_re.search(line)
 
 	# end of line
-	man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, man.factory.makeWord(line + suffix)))
+	man.send(doc.ObjectEvent(doc.L_WORD, doc.ID_NEW, man.factory.makeWord(line[pos:] + suffix)))
 
 
 ############### Line Parsing ######################
@@ -123,6 +153,7 @@ def handleInclude(man, match):
 	path = match.group(1).strip()
 	if not os.path.isabs(path):
 		path = os.path.join(os.path.dirname(man.file_name), path)
+	man.add_input(path)
 	try:
 		file = open(path, encoding="utf8")
 		man.parseInternal(file, path)
@@ -173,6 +204,114 @@ __lines__ = [
 INITIAL_LINES = [(f, re.compile(e)) for (f, e, _) in __lines__]
 
 
+def strip_groups(text):
+	"""Rewrite the regular expression text to make its capturing groups
+	non-capturing so that it can be merged with other expressions.
+	Return None if the expression cannot be merged (back-references,
+	global flags, conditional groups)."""
+	res = []
+	i = 0
+	n = len(text)
+	while i < n:
+		c = text[i]
+
+		# escaped character (back-references are not supported)
+		if c == '\\':
+			if i + 1 < n and text[i + 1] in "123456789":
+				return None
+			res.append(text[i:i+2])
+			i += 2
+
+		# character class: copied as is
+		elif c == '[':
+			j = i + 1
+			if j < n and text[j] == '^':
+				j += 1
+			if j < n and text[j] == ']':
+				j += 1
+			while j < n and text[j] != ']':
+				if text[j] == '\\':
+					j += 1
+				j += 1
+			res.append(text[i:j+1])
+			i = j + 1
+
+		# group
+		elif c == '(':
+			if text.startswith("(?P<", i):
+				j = text.find('>', i)
+				if j < 0:
+					return None
+				res.append("(?:")
+				i = j + 1
+			elif text.startswith("(?P=", i) or text.startswith("(?(", i):
+				return None
+			elif text.startswith("(?", i):
+				j = i + 2
+				while j < n and text[j].isalpha():
+					j += 1
+				if j < n and text[j] == ')':
+					return None
+				res.append(c)
+				i += 1
+			else:
+				res.append("(?:")
+				i += 1
+
+		# any other character
+		else:
+			res.append(c)
+			i += 1
+
+	return "".join(res)
+
+
+class LineDispatcher:
+	"""Select the line handler of a list of pairs (function, RE) in one
+	pass: the REs are merged in alternations with named groups, tried in
+	the same order as the list. REs that cannot be merged are kept
+	alone between the alternations."""
+
+	def __init__(self, lines):
+		self.segments = []
+		text = ""
+		group = []
+		for (fun, line_re) in lines:
+			stext = None
+			if line_re.flags & ~re.UNICODE == 0:
+				stext = strip_groups(line_re.pattern)
+			if stext is None:
+				if group:
+					self.segments.append((re.compile(text), group))
+					text = ""
+					group = []
+				self.segments.append((None, [(fun, line_re)]))
+			else:
+				if text != "":
+					text = text + "|"
+				text = text + "(?P<l" + str(len(group)) + ">" + stext + ")"
+				group.append((fun, line_re))
+		if group:
+			self.segments.append((re.compile(text), group))
+
+	def dispatch(self, man, line):
+		"""Call the handler of the first matching RE with the given line.
+		Return True if a handler has been found, False else."""
+		for (seg_re, group) in self.segments:
+			if seg_re is None:
+				fun, line_re = group[0]
+			else:
+				match = seg_re.match(line)
+				if not match:
+					continue
+				fun, line_re = group[int(match.lastgroup[1:])]
+			match = line_re.match(line)
+			if match:
+				fun(man, match)
+				return True
+		return False
+
+
 class LineParser:
 	"""Abstract class of line parser."""
 
@@ -190,14 +329,9 @@ class DefaultParser(LineParser):
 
 	def parse(self, manager, line):
 		line = manager.doc.reduceVars(line)
-		done = False
-		for (fun, re) in manager.lines:
-			match = re.match(line)
-			if match:
-				fun(manager, match)
-				done = True
-				break
-		if not done:
+		if manager.lines_disp is None:
+			manager.lines_disp = compile_lines(manager.lines)
+		if not manager.lines_disp.dispatch(manager, line):
 			handleText(manager, line)
 
 
@@ -234,6 +368,7 @@ class Manager:
 		self.info = None
 		self.completers = None
 		self.lines = None
+		self.lines_disp = None
 		self.words = None
 		self.words_re = None
 
@@ -244,6 +379,28 @@ class Manager:
 		analysis. This may be used to perform checking for example."""
 		self.completers.append(completer)
 
+	def add_input(self, path):
+		"""Record a file read during the parsing, even if it cannot be
+		read, so that what depends on the document (like the cache of
+		parsed documents) is invalidated when the file changes."""
+		self.inputs.append(path)
+
+	def merge_text(self, word, text):
+		"""Append text to a word. The texts of consecutive words are
+		collected and joined once by flush_text()."""
+		if self.merged is not word:
+			self.flush_text()
+			self.merged = word
+			self.merged_parts = [word.text]
+		self.merged_parts.append(text)
+
+	def flush_text(self):
+		"""Set the text of the word built by merge_text()."""
+		if self.merged is not None:
+			self.merged.text = "".join(self.merged_parts)
+			self.merged = None
+			self.merged_parts = None
+
 	def make_par(self):
 		"""Build a paragraph to be used in the document."""
 		return self.factory.makePar()
@@ -269,6 +426,9 @@ class Manager:
 		self.file_name = None
 		self.info = {}
 		self.completers = []
+		self.inputs = []
+		self.merged = None
+		self.merged_parts = None
 
 	def close_to_top(self):
 		"""Close the current stack to top-level."""
@@ -278,8 +438,9 @@ class Manager:
 	def clear(self, document = None):
 		"""Reset the parser in the initial state."""
 		self.reset(document)
-		self.lines = INITIAL_LINES
-		self.words = INITIAL_WORDS
+		self.lines = list(INITIAL_LINES)
+		self.lines_disp = None
+		self.words = list(INITIAL_WORDS)
 		self.words_re = None
 		self.added_lines = []
 		self.added_words = []
@@ -352,7 +513,7 @@ class Manager:
 		prev_line = self.line_num
 		prev_file = self.file_name
 		self.line_num = 0
-		self.file_name = name
+		self.file_name = sys.intern(name)
 		for line in file:
 			self.line_num += 1
 			if line[-1] == '\n':
@@ -368,6 +529,7 @@ class Manager:
 		"""Parse the given file. The file may be an input stream or
 		a file name. Raise common.ParseException in case of error."""
 		if isinstance(file, str):
+			self.add_input(file)
 			try:
 				with open(file, encoding="utf8") as input:
 					self.parse(input, file)
@@ -389,6 +551,7 @@ class Manager:
 				# perform the parse
 				self.parseInternal(file, name)
 				self.send(doc.Event(doc.L_DOC, doc.ID_END))
+				self.flush_text()
 				for completer in self.completers:
 					completer(self)
 
@@ -400,6 +563,7 @@ class Manager:
 		(f, re) with f the function to call when the RE re is found."""
 		self.added_lines.append(line)
 		self.lines.append(line)
+		self.lines_disp = None
 
 	def addWord(self, word):
 		self.added_words.append(word)
@@ -415,6 +579,7 @@ class Manager:
 		self.lines.extend(INITIAL_LINES)
 		self.lines.extend(self.added_lines)
 		self.lines.extend(lines)
+		self.lines_disp = None
 
 		# process words
 		self.words = []
@@ -446,10 +611,10 @@ class Manager:
 	def use(self, name):
 		"""Use a module in the current parser."""
 		assert name is not None
-		if name in self.used_mods:
-			return
 		path = self.doc.getVar("THOT_USE_PATH")
 		mod = common.loadModule(name, path)
+		if mod in self.used_mods:
+			return
 		if mod:
 			self.used_mods.append(mod)
 			if "init" in mod.__dict__:
@@ -472,21 +637,21 @@ class Manager:
 				except AttributeError:
 					pass
 				self.setSyntax(
-					[(l[0], re.compile(l[1])) for l in lines],
+					[(l[0], compile_re(l[1])) for l in lines],
 					[(w[0], w[1]) for w in words])
 
 			# simple extension
 			else:
 				if"__lines__" in  mod.__dict__:
 					for line in mod.__lines__:
-						self.addLine((line[0], re.compile(line[1])))
+						self.addLine((line[0], compile_re(line[1])))
 				if "__words__" in mod.__dict__:
 					for word in mod.__words__:
 						self.addWord((word[0], word[1]))
 				if "__syntaxes__" in mod.__dict__:
 					for s in mod.__syntaxes__:
 						for (f, r) in s.get_lines():
-							self.addLine((f, re.compile(r)))
+							self.addLine((f, compile_re(r)))
 						for w in s.get_words():
 							self.addWord(w)
 		else:
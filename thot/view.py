@@ -17,10 +17,19 @@
 """Implements the command thot-view."""
 
 import argparse
+import collections
+import concurrent.futures
+import email.utils
+import gzip
+import hashlib
+import html
 import http.server
+import io
+import json
 import mimetypes
 import os
 import os.path
+import select
 import shutil
 import sys
 import tempfile
@@ -30,15 +39,26 @@ from urllib.parse import unquote
 import webbrowser
 
 #from thot import command
+from thot import back
 from thot import common
 from thot import doc
 from thot import tparser
+from thot import watch
 from thot.backs import abstract_html as ahtml
 
 
 # Heartbeat time-out in seconds.
 HEARTBEAT_TIMEOUT = 1.5
 
+# Number of requests processed in parallel.
+WORKERS = 8
+
+# Number of prefetched pages, not displayed yet, kept in memory.
+PREFETCH_SIZE = 8
+
+# Period in seconds of check for server idleness before prefetch.
+PREFETCH_DELAY = .05
+
 PARSERS = {
 	".md": "markdown",
 	".thot": None,
@@ -46,6 +66,9 @@ PARSERS = {
 	".textile": "textile"
 }
 
+# Minimal size in bytes of a compressed content.
+GZIP_MIN = 256
+
 TEXT_MIMES = {
 	"application/javascript",
 	"text/css",
@@ -56,6 +79,49 @@ TEXT_MIMES = {
 	"text/xml"
 }
 
+def compress(data):
+	"""Compress the data with gzip. Return None if the data is too small
+	to gain anything from compression."""
+	if data is None or len(data) < GZIP_MIN:
+		return None
+	return gzip.compress(data, mtime = 0)
+
+
+class Content:
+	"""Snapshot of the content of a resource taken by prepare(): the
+	validators, the size and the data sent to answer a request stay
+	consistent even if the resource is rebuilt meanwhile. If data is
+	None, the content is sent from the file at path."""
+
+	def __init__(self, etag, date, data = None, path = None, size = None):
+		self.etag = etag
+		self.date = date
+		self.data = data
+		self.path = path
+		if data is not None:
+			self.size = len(data)
+		else:
+			self.size = size
+		self.compressed = None
+
+	def get_gzip(self):
+		"""Get the content compressed with gzip or None if it is not
+		sent compressed."""
+		compressed = self.compressed
+		if compressed is None:
+			compressed = (compress(self.data), )
+			self.compressed = compressed
+		return compressed[0]
+
+	def send(self, out):
+		"""Send the content to the request handler out."""
+		if self.data is not None:
+			out.write_bin(self.data)
+		else:
+			with open(self.path, "rb") as file:
+				out.send_file(file, self.size)
+
+
 class Resource:
 	"""Base class of ressources used by the server. They are identified
 	by a relative location used by the server to provide them."""
@@ -68,11 +134,26 @@ class Resource:
 		"""Called to get MIME type."""
 
 	def prepare(self):
-		"""Prepare the generation."""
+		"""Prepare the generation. Return the Content to send or None
+		if the answer is produced by generate() at each request."""
+		return None
+
+	def invalidate(self):
+		"""Called when a file the resource depends on is modified."""
 		pass
 
+	def get_links(self):
+		"""Get the document resources linked by this resource."""
+		return []
+
+	def is_released(self):
+		"""Test if the resource has been released: it is not rebuilt
+		when the files it depends on are modified."""
+		return False
+
 	def generate(self, out):
-		"""Called to generate on the given output."""
+		"""Called to generate on the given output when prepare()
+		returns None."""
 		pass
 
 	def post(self, size, input):
@@ -113,6 +194,25 @@ class HeartBeatResource(Resource):
 		return "<heartbeat>"
 
 
+class EventResource(Resource):
+	"""Resource opening a stream of server-sent events: the connection
+	is passed to fun that is in charge of it."""
+
+	def __init__(self, loc, fun):
+		Resource.__init__(self, loc)
+		self.fun = fun
+
+	def get_mime(self):
+		return "text/event-stream"
+
+	def generate(self, out):
+		out.write("retry: 1000\n\n")
+		self.fun(out.connection)
+
+	def __str__(self):
+		return "<events>"
+
+
 class ActionResource(Resource):
 
 	def __init__(self, loc, fun = lambda: None):
@@ -131,48 +231,72 @@ class ActionResource(Resource):
 
 
 class FileResource(Resource):
-	"""Resource for the content of a file."""
+	"""Resource for the content of a file. The content of text files
+	is kept in memory (and compressed) as long as the file is not
+	modified. Binary files are sent with sendfile()."""
 
 	def __init__(self, path, loc):
 		Resource.__init__(self, loc)
 		self.path = path
+		self.stat = None
+		self.content = None
+		self.lock = threading.Lock()
 
 	def get_mime(self):
 		return mimetypes.guess_type(self.path)[0]
 
 	def prepare(self):
+		self.manager.watch(self, [self.path])
 		if not os.access(self.path, os.R_OK):
 			raise common.ThotException(f"cannot access {self.path}")
-
-	def generate(self, out):
+		try:
+			stat = os.stat(self.path)
+		except OSError as e:
+			raise common.ThotException(f"cannot access {self.path}: {e}")
+		with self.lock:
+			if self.stat is None \
+			or self.stat.st_mtime_ns != stat.st_mtime_ns \
+			or self.stat.st_size != stat.st_size:
+				self.content = Content(
+					f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+					stat.st_mtime,
+					self.load(),
+					self.path,
+					stat.st_size)
+				self.stat = stat
+			return self.content
+
+	def load(self):
+		"""Load the content of a text file. Return None for a binary file."""
 		ext = os.path.splitext(self.path)[1]
 
 		# relocated file
 		if ext in ahtml.RELOCATORS:
 			reloc = ahtml.RELOCATORS[ext]
+			out = io.StringIO()
 			reloc.move_to_stream(self.path, self.loc, out, self.manager)
+			return out.getvalue().encode("utf-8")
 
-		# send text file
+		# text file
 		elif self.get_mime() in TEXT_MIMES:
-			with open(self.path, encoding="utf-8") as file:
-				for l in file:
-					out.write(l)
+			with open(self.path, "rb") as file:
+				return file.read()
 
-		# send binary file
+		# binary file
 		else:
-			file = open(self.path, "rb")
-			while True:
-				b = file.read(4096)
-				if b == b'':
-					break
-				else:
-					out.write_bin(b)
-			file.close()
+			return None
 
 	def __str__(self):
 		return self.path
 
 
+ERROR_PAGE = """<!DOCTYPE html>
+<html>
+<head><title>Error</title><script>{script}</script></head>
+<body><h1>Error</h1><pre>{message}</pre></body>
+</html>
+"""
+
 VIEW_SCRIPT = """
 	const thot_request = new XMLHttpRequest();
 
@@ -186,10 +310,24 @@ VIEW_SCRIPT = """
 		sleep(500);
 	}
 
-	function heartbeat() {
-		send("/heartbeat");
+	function uses(url) {
+		for(const e of document.querySelectorAll("img, script, link"))
+			if(e.src == url || e.href == url)
+				return true;
+		return false;
 	}
-	setInterval(heartbeat, 1000);
+
+	const thot_events = new EventSource("/events");
+	thot_events.addEventListener("change", function(event) {
+		const page = location.href.split("#")[0];
+		for(const loc of JSON.parse(event.data)) {
+			const url = new URL(loc, page).href;
+			if(url == page || uses(url)) {
+				location.reload();
+				break;
+			}
+		}
+	});
 """
 
 
@@ -203,6 +341,7 @@ class Generator(ahtml.Generator):
 			template = doc.get_template())
 		self.base_level = doc.get_base_level()
 		self.out_path = doc.get_location()
+		self.links = []
 		script = self.newScript()
 		script.content = VIEW_SCRIPT
 
@@ -215,6 +354,7 @@ class Generator(ahtml.Generator):
 	def genLinkBegin(self, url, title = None):
 		if not self.is_distant_url(url):
 			url = self.manager.use_resource(url)
+			self.links.append(url)
 		ahtml.Generator.genLinkBegin(self, url, title)
 
 
@@ -247,7 +387,8 @@ class ViewTemplate(ahtml.FileTemplate):
 
 
 class DocResource(Resource, ahtml.TemplateHandler):
-	"""Generator for Thot document."""
+	"""Generator for Thot document. The document is parsed and rendered
+	by one thread at a time."""
 
 	def __init__(self, document, man, loc):
 		Resource.__init__(self, loc, man)
@@ -260,17 +401,85 @@ class DocResource(Resource, ahtml.TemplateHandler):
 		self.env = None
 		self.title = None
 		self.base_level = None
+		self.inputs = []
+		self.stamp = None
+		self.content = None
+		self.valid = False
+		self.links = []
+		self.lock = threading.Lock()
 
 	def get_mime(self):
 		return "text/html"
 
+	def get_stamp(self):
+		"""Get the stamp of the files the page depends on: the document,
+		its included files, the template and the style. The stamp is
+		a tuple of (path, modification time) pairs."""
+		stamp = []
+		for path in self.inputs:
+			try:
+				stamp.append((path, os.stat(path).st_mtime_ns))
+			except OSError:
+				stamp.append((path, None))
+		return tuple(stamp)
+
 	def prepare(self):
-		"""Read the document."""
-		if self.node is not None \
-		and self.date >= os.stat(self.document).st_mtime:
-			return
+		"""Read the document and render the page, if one of the files
+		it depends on has changed."""
+		with self.lock:
+			if self.node is None or not self.is_valid():
+				self.update()
+			return self.content
+
+	def is_valid(self):
+		"""Test if the rendered page is up to date. If the files are
+		not watched, their modification times are checked."""
+		if self.manager.watcher is not None:
+			return self.valid
+		else:
+			return self.get_stamp() == self.stamp
+
+	def invalidate(self):
+		self.valid = False
+
+	def get_links(self):
+		return self.links
+
+	def is_released(self):
+		return self.node is None
+
+	def release(self):
+		"""Free the document and the page: they will be rebuilt at next
+		prepare(). The files are no more watched for this resource.
+		The resource must be locked."""
+		self.node = None
+		self.content = None
+		self.valid = False
+		self.get_manager().unwatch(self)
+
+	def update(self):
+		"""Parse the document and render the page. In case of error,
+		the resource is released and a ThotException is raised."""
+		self.valid = True
+		try:
+			self.build()
+		except common.ThotException:
+			self.fail()
+			raise
+		except Exception as e:
+			self.fail()
+			raise common.ThotException(f"cannot build {self.document}: {e}")
+
+	def fail(self):
+		"""Release the resource after a failed build but keep watching
+		the files read so far: the error page is reloaded when they
+		are fixed."""
+		self.release()
+		self.get_manager().watch(self, [self.document] + self.inputs)
+
+	def build(self):
+		"""Perform the parsing and the rendering for update()."""
 		self.env = self.manager.env.copy()
-		parser = self.manager.parser
 
 		# prepare the environment
 		self.env["THOT_FILE"] = self.document
@@ -283,10 +492,17 @@ class DocResource(Resource, ahtml.TemplateHandler):
 
 		# build the document
 		self.node = doc.Document(self.env)
-		parser.clear(self.node)
-		self.get_manager().mon.say("parsing %s", self.document)
-		parser.parse(self.document)
-		self.date = os.stat(self.document).st_mtime
+		self.get_manager().watch(self, [self.document])
+		parser = self.get_manager().get_parser()
+		try:
+			parser.clear(self.node)
+			self.get_manager().mon.say("parsing %s", self.document)
+			parser.parse(self.document)
+		finally:
+			inputs = list(parser.inputs)
+			self.inputs = inputs
+			self.get_manager().watch(self, inputs)
+			self.get_manager().release_parser(parser)
 
 		# look for the structure
 		if self.get_manager().single:
@@ -307,6 +523,14 @@ class DocResource(Resource, ahtml.TemplateHandler):
 		# prepare links
 		self.make_links()
 
+		# render the page
+		self.style_author = None
+		self.inputs = inputs + [self.get_template_path(), css[0]]
+		self.stamp = self.get_stamp()
+		self.get_manager().watch(self, self.inputs)
+		self.date = max(t for (_, t) in self.stamp if t is not None) / 1e9
+		self.render()
+
 	def get_document(self):
 		"""Get the documenty itself for this resource."""
 		return self.node
@@ -341,24 +565,27 @@ class DocResource(Resource, ahtml.TemplateHandler):
 			icon = self.manager.get_resource_link(icon, self.get_location())
 			gen.out.write(f'<div class="icon"><img src="{icon}"/></div>')
 
-	def generate(self, out):
-		if self.node is None:
-			self.prepare()
-		path = os.path.join(self.node.env["THOT_BASE"], "view/template.html")
-		ViewTemplate(self, path)
+	def render(self):
+		"""Generate the page in memory."""
 		gen = Generator(self)
 		self.node.pregen(gen)
-		gen.out = out
+		gen.out = back.Output()
 		gen.getTemplate().apply(self, gen)
+		page = gen.out.get_bytes()
+		self.content = Content(f'"{hashlib.sha1(page).hexdigest()}"', self.date, page)
+		self.links = self.get_manager().get_documents(gen.links, self)
+
+	def get_template_path(self):
+		"""Get the path of the template file."""
+		if self.get_manager().single:
+			return os.path.join(self.node.env["THOT_BASE"], "themes/plain.html")
+		else:
+			return os.path.join(self.node.env["THOT_BASE"], "view/template.html")
 
 	def get_template(self):
 		"""Get the temlate of the document resource."""
 		if self.template is None:
-			if self.get_manager().single:
-				path = os.path.join(self.node.env["THOT_BASE"], "themes/plain.html")
-			else:
-				path = os.path.join(self.node.env["THOT_BASE"], "view/template.html")
-			self.template = ViewTemplate(self, path)
+			self.template = ViewTemplate(self, self.get_template_path())
 		return self.template
 
 	def gen_header(self, gen):
@@ -396,6 +623,9 @@ class Manager(ahtml.Manager):
 		self.mon.set_verbosity(verbose)
 		self.tmpdir = None
 		self.single = single
+		self.lock = threading.RLock()
+		self.watcher = None
+		self.dependents = {}
 
 		# prepare environment
 		self.env = common.Env()
@@ -432,6 +662,8 @@ class Manager(ahtml.Manager):
 				self.mon.error("error in parsing %s: %s (ignoring)",
 					config_path, e)
 
+		self.parsers = [self.parser]
+
 		# prepare file system
 		self.fsmap = {}
 		self.counter = 0
@@ -452,16 +684,81 @@ class Manager(ahtml.Manager):
 	def is_interactive(self):
 		return True
 
+	def get_parser(self):
+		"""Get a parser not used by another thread. It must be given back
+		with release_parser()."""
+		with self.lock:
+			if self.parsers:
+				return self.parsers.pop()
+		return tparser.Manager(self.base_doc)
+
+	def release_parser(self, parser):
+		"""Give back a parser obtained by get_parser()."""
+		with self.lock:
+			self.parsers.append(parser)
+
+	def watch(self, res, paths):
+		"""Record that the resource depends on the given files.
+		Nothing is done if there is no watcher."""
+		if self.watcher is None:
+			return
+		with self.lock:
+			for path in paths:
+				path = os.path.abspath(path)
+				if self.tmpdir is not None and path.startswith(self.tmpdir):
+					continue
+				self.dependents.setdefault(path, set()).add(res)
+				self.watcher.watch(path)
+
+	def unwatch(self, res):
+		"""Forget the files the resource depends on."""
+		with self.lock:
+			for path in [p for (p, s) in self.dependents.items() if res in s]:
+				deps = self.dependents[path]
+				deps.discard(res)
+				if not deps:
+					del self.dependents[path]
+
+	def get_dependents(self, paths):
+		"""Get the resources depending on the given files."""
+		res = set()
+		with self.lock:
+			for path in paths:
+				res |= self.dependents.get(path, set())
+		return res
+
+	def get_documents(self, paths, res):
+		"""Get the document resources, different from res, corresponding
+		to the given paths."""
+		docs = []
+		with self.lock:
+			for path in paths:
+				doc = self.fsmap.get(path)
+				if isinstance(doc, DocResource) and doc is not res and doc not in docs:
+					docs.append(doc)
+		return docs
+
+	def get_locations(self, res):
+		"""Get the locations of a resource."""
+		with self.lock:
+			return [loc for (loc, r) in self.map.items() if r is res]
+
 	def alias_resource(self, res, loc):
 		"""Add an aliases to a resource."""
 		self.mon.say("alias %s to %s", res, loc)
-		self.map[loc] = res
+		with self.lock:
+			self.map[loc] = res
 
 	def link_resource(self, res):
 		"""Add a resource."""
-		self.map[res.loc] = res
+		with self.lock:
+			self.map[res.loc] = res
 		res.manager = self
 
+	def declare_link(self, node, path, anchor = ""):
+		with self.lock:
+			ahtml.Manager.declare_link(self, node, path, anchor)
+
 	def make_gen(self, path, loc):
 		"""Build a generator for the given path."""
 		ext = os.path.splitext(path)[1]
@@ -472,6 +769,11 @@ class Manager(ahtml.Manager):
 			return FileResource(path, loc)
 
 	def use_resource(self, path):
+		with self.lock:
+			return self.use_resource_locked(path)
+
+	def use_resource_locked(self, path):
+		"""Same as use_resource() but the manager must be locked."""
 		rpath = os.path.normpath(os.path.abspath(path))
 		if rpath not in self.fsmap:
 			if rpath.startswith(self.base_dir):
@@ -490,6 +792,11 @@ class Manager(ahtml.Manager):
 		return rpath
 
 	def new_resource(self, path = None, ext = None):
+		with self.lock:
+			return self.new_resource_locked(path, ext)
+
+	def new_resource_locked(self, path, ext):
+		"""Same as new_resource() but the manager must be locked."""
 		if self.tmpdir is None:
 			self.tmpdir = os.path.abspath(tempfile.mkdtemp(prefix = "thot-"))
 		if path is None:
@@ -519,6 +826,85 @@ class Manager(ahtml.Manager):
 		return None
 
 
+class Prefetcher:
+	"""Parses and renders in background the documents linked by the last
+	displayed page, so that following a link does not wait for it.
+	The documents are prepared one by one, only when the server is idle,
+	and the remaining ones are cancelled when another page is displayed.
+	At most size prefetched pages, not displayed yet, are kept."""
+
+	def __init__(self, server, size = PREFETCH_SIZE):
+		self.server = server
+		self.size = size
+		self.todo = collections.deque()
+		self.kept = collections.OrderedDict()
+		self.visited = set()
+		self.cond = threading.Condition()
+		if size > 0:
+			threading.Thread(target = self.run, daemon = True).start()
+
+	def visit(self, res):
+		"""Called before a page is prepared for display: the pending
+		prefetches are cancelled."""
+		if isinstance(res, DocResource):
+			with self.cond:
+				self.visited.add(res)
+				self.kept.pop(res, None)
+				self.todo.clear()
+
+	def schedule(self, res):
+		"""Called after a page is prepared for display to prefetch its
+		linked documents."""
+		if isinstance(res, DocResource) and self.size > 0:
+			with self.cond:
+				self.todo.clear()
+				for doc in res.get_links():
+					if doc not in self.visited and doc not in self.kept:
+						self.todo.append(doc)
+				self.cond.notify()
+
+	def run(self):
+		while True:
+			with self.cond:
+				while not self.todo:
+					self.cond.wait()
+			self.server.wait_idle()
+			with self.cond:
+				if not self.todo:
+					continue
+				res = self.todo.popleft()
+			self.server.mon.say("prefetching %s", res)
+			try:
+				res.prepare()
+			except Exception as e:
+				# the resource is left released by DocResource.update()
+				# and will be built again, and the error reported, when
+				# it is requested
+				self.server.mon.say("cannot prefetch %s: %s", res, e)
+				continue
+			if res.content is None:
+				continue
+			with self.cond:
+				if res in self.visited:
+					continue
+				self.kept[res] = None
+				if len(self.kept) > self.size:
+					old, _ = self.kept.popitem(last = False)
+				else:
+					old = None
+			if old is not None:
+				self.evict(old)
+
+	def evict(self, res):
+		"""Release a prefetched page, unless it has been displayed
+		in between."""
+		with res.lock:
+			with self.cond:
+				if res in self.visited:
+					return
+			res.release()
+
+
 class RequestHandler(http.server.SimpleHTTPRequestHandler):
 
 	def write(self, text):
@@ -527,29 +913,116 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
 	def write_bin(self, text):
 		self.wfile.write(text)
 
+	def send_file(self, file, size):
+		"""Send size bytes of the given file, with sendfile() if the system
+		supports it."""
+		self.connection.sendfile(file, 0, size)
+
+	def accepts_gzip(self):
+		"""Test if the client accepts gzip encoding."""
+		for item in self.headers.get("Accept-Encoding", "").split(","):
+			args = [a.strip() for a in item.split(";")]
+			if args[0] in ("gzip", "*"):
+				return "q=0" not in args and "q=0.0" not in args
+		return False
+
 	def do_GET(self):
 		self.server.record_heartbeat()
 		path = unquote(self.path)
 		try:
 			file = self.server.manager.map[path]
-			self.server.disable_heartbeat()
-			file.prepare()
-			self.server.enable_heartbeat()
 		except KeyError:
-			self.server.enable_heartbeat()
 			msg = f"{path} not found"
 			self.send_error(404, msg)
 			return
+		try:
+			self.server.disable_heartbeat()
+			self.server.prefetcher.visit(file)
+			content = file.prepare()
 		except common.ThotException as e:
-			self.server.enable_heartbeat()
-			self.send_error(500)
+			self.send_failure(e)
 			self.error(f"error for {path}: {e}")
 			return
+		finally:
+			self.server.enable_heartbeat()
+		self.server.prefetcher.schedule(file)
+
+		# dynamic content
+		if content is None:
+			self.send_response(200)
+			self.send_header("Content-type",  file.get_mime())
+			self.end_headers()
+			file.generate(self)
+			return
+
+		# select the encoding
+		etag = content.etag
+		date = content.date
+		data = None
+		if self.accepts_gzip():
+			data = content.get_gzip()
+			if data is not None and etag is not None:
+				etag = etag[:-1] + '-gzip"'
+
+		# conditional request
+		if self.is_not_modified(etag, date):
+			self.send_response(304)
+			self.send_validators(etag, date)
+			self.end_headers()
+			return
 
 		self.send_response(200)
 		self.send_header("Content-type",  file.get_mime())
+		if data is not None:
+			self.send_header("Content-Encoding", "gzip")
+			self.send_header("Content-Length", str(len(data)))
+		elif content.size is not None:
+			self.send_header("Content-Length", str(content.size))
+		self.send_validators(etag, date)
+		self.end_headers()
+		if data is not None:
+			self.write_bin(data)
+		else:
+			content.send(self)
+
+	def send_failure(self, e):
+		"""Send an error page for the exception. The page is reloaded
+		when the files of the resource are modified."""
+		page = ERROR_PAGE.format(
+			script = VIEW_SCRIPT,
+			message = html.escape(str(e))).encode("utf-8")
+		self.send_response(500)
+		self.send_header("Content-type", "text/html")
+		self.send_header("Content-Length", str(len(page)))
+		self.send_header("Cache-Control", "no-store")
 		self.end_headers()
-		file.generate(self)
+		self.write_bin(page)
+
+	def send_validators(self, etag, date):
+		"""Send the headers allowing the browser to validate its copy
+		of the resource."""
+		if etag is not None:
+			self.send_header("ETag", etag)
+		if date is not None:
+			self.send_header("Last-Modified", email.utils.formatdate(date, usegmt = True))
+		if etag is not None or date is not None:
+			self.send_header("Cache-Control", "no-cache")
+			self.send_header("Vary", "Accept-Encoding")
+
+	def is_not_modified(self, etag, date):
+		"""Test if the request is conditional and the copy of the
+		browser is still valid."""
+		match = self.headers.get("If-None-Match")
+		if match is not None:
+			return etag is not None \
+				and (match.strip() == "*" or etag in [t.strip() for t in match.split(",")])
+		since = self.headers.get("If-Modified-Since")
+		if since is not None and date is not None:
+			try:
+				return int(date) <= email.utils.parsedate_to_datetime(since).timestamp()
+			except (TypeError, ValueError):
+				return False
+		return False
 
 	def do_POST(self):
 		self.server.record_heartbeat()
@@ -564,14 +1037,13 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
 			return
 
 		# process message
+		self.server.disable_heartbeat()
 		try:
 
 			# post the message
-			self.server.disable_heartbeat()
 			res = file.post(int(self.headers['content-length']), self.rfile)
 			if res is not None:
 				self.send_error(res[0], res[1])
-				self.server.enable_heartbeat()
 				return
 
 			# build answer
@@ -579,14 +1051,15 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
 			self.send_header("Content-type",  file.get_mime())
 			self.end_headers()
 			file.answer(self.wfile)
-			self.server.enable_heartbeat()
 
 		except common.ThotException as e:
-			self.server.enable_heartbeat()
 			self.send_error(500)
 			self.error(f"error for {path}:  {e}")
 			return
 
+		finally:
+			self.server.enable_heartbeat()
+
 	def error(self, msg):
 		self.server.mon.error(msg)
 
@@ -598,8 +1071,10 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
 
 
 class MyServer(http.server.HTTPServer):
+	"""Server processing the requests in parallel with a pool of
+	workers threads."""
 
-	def __init__(self, manager):
+	def __init__(self, manager, workers = WORKERS, prefetch = PREFETCH_SIZE):
 		http.server.HTTPServer.__init__(self,
 			('localhost', 0),
 			RequestHandler)
@@ -609,7 +1084,100 @@ class MyServer(http.server.HTTPServer):
 		manager.link_resource(ActionResource("/heartbeat", self.record_heartbeat))
 		self.heartbeat_started = False
 		self.last_heartbeat = None
-		self.heartbeat_pause = False
+		self.heartbeat_pause = 0
+		self.heartbeat_lock = threading.Lock()
+		self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+		self.clients = set()
+		self.clients_lock = threading.Lock()
+		self.busy = 0
+		self.busy_lock = threading.Lock()
+		self.prefetcher = Prefetcher(self, prefetch)
+		manager.link_resource(EventResource("/events", self.add_client))
+		manager.watcher = watch.make_watcher(self.on_change)
+		manager.watcher.start()
+
+	def process_request(self, request, client_address):
+		self.pool.submit(self.process_request_thread, request, client_address)
+
+	def process_request_thread(self, request, client_address):
+		"""Process the request in a worker thread. The connections
+		of event streams are kept open."""
+		with self.busy_lock:
+			self.busy += 1
+		try:
+			self.finish_request(request, client_address)
+		except Exception:
+			self.handle_error(request, client_address)
+		finally:
+			with self.busy_lock:
+				self.busy -= 1
+			with self.clients_lock:
+				keep = request in self.clients
+			if not keep:
+				self.shutdown_request(request)
+
+	def server_close(self):
+		http.server.HTTPServer.server_close(self)
+		self.manager.watcher.stop()
+		with self.clients_lock:
+			for sock in self.clients:
+				self.shutdown_request(sock)
+			self.clients.clear()
+		self.pool.shutdown(wait = False)
+
+	def wait_idle(self):
+		"""Wait until no request is being processed."""
+		while self.busy:
+			time.sleep(PREFETCH_DELAY)
+
+	def add_client(self, sock):
+		"""Add a connection receiving the events."""
+		with self.clients_lock:
+			self.clients.add(sock)
+
+	def check_clients(self):
+		"""Remove the closed event connections and return the number
+		of remaining ones."""
+		with self.clients_lock:
+			if self.clients:
+				ready, _, _ = select.select(list(self.clients), [], [], 0)
+				for sock in ready:
+					try:
+						data = sock.recv(1024)
+					except OSError:
+						data = b""
+					if not data:
+						self.clients.remove(sock)
+						self.shutdown_request(sock)
+			return len(self.clients)
+
+	def send_event(self, event, data):
+		"""Send an event to all connected pages."""
+		msg = f"event: {event}\ndata: {data}\n\n".encode("utf8")
+		with self.clients_lock:
+			for sock in list(self.clients):
+				try:
+					sock.sendall(msg)
+				except OSError:
+					self.clients.remove(sock)
+					self.shutdown_request(sock)
+
+	def on_change(self, paths):
+		"""Called by the watcher when files are modified: the depending
+		resources are rebuilt in background and the pages notified."""
+		for res in self.manager.get_dependents(paths):
+			res.invalidate()
+			self.pool.submit(self.refresh, res)
+
+	def refresh(self, res):
+		"""Rebuild a resource and notify the pages. A released resource
+		(like a page in error) is only notified."""
+		if not res.is_released():
+			try:
+				res.prepare()
+			except common.ThotException as e:
+				self.mon.error(f"error for {res}: {e}")
+		self.send_event("change", json.dumps(self.manager.get_locations(res)))
 
 	def get_address(self):
 		return self.socket.getsockname()
@@ -630,27 +1198,37 @@ class MyServer(http.server.HTTPServer):
 			http.server.HTTPServer.serve_forever(self)
 		except KeyboardInterrupt:
 			self.shutdown()
+		self.server_close()
 
 	def check_heartbeat(self):
+		"""Quit when no page is open: no event connection and no
+		request for HEARTBEAT_TIMEOUT."""
 		while True:
 			time.sleep(HEARTBEAT_TIMEOUT)
+			if self.check_clients():
+				self.record_heartbeat()
 			delay = time.time() - self.last_heartbeat
 			if not self.heartbeat_pause and delay > HEARTBEAT_TIMEOUT:
 				self.quit()
 				break
 
 	def record_heartbeat(self):
-		self.last_heartbeat = time.time()
-		if not self.heartbeat_started:
-			self.heartbeat_started = True
-			threading.Thread(target = self.check_heartbeat).start()
+		with self.heartbeat_lock:
+			self.last_heartbeat = time.time()
+			if not self.heartbeat_started:
+				self.heartbeat_started = True
+				threading.Thread(target = self.check_heartbeat).start()
 
 	def disable_heartbeat(self):
-		self.heartbeat_pause = True
+		"""Suspend the heartbeat check while a resource is prepared."""
+		with self.heartbeat_lock:
+			self.heartbeat_pause += 1
 
 	def enable_heartbeat(self):
-		self.last_heartbeat = time.time()
-		self.heartbeat_pause = False
+		"""Resume the heartbeat check after disable_heartbeat()."""
+		with self.heartbeat_lock:
+			self.last_heartbeat = time.time()
+			self.heartbeat_pause -= 1
 
 
 def main():
@@ -668,6 +1246,10 @@ def main():
 		help="Enable verbose mode.")
 	parser.add_argument("--version", action="store_true",
 		help="print version")
+	parser.add_argument("-j", "--jobs", type=int, default=WORKERS,
+		help=f"Number of requests processed in parallel (default {WORKERS}).")
+	parser.add_argument("--prefetch", type=int, default=PREFETCH_SIZE,
+		help=f"Number of linked pages prepared in advance and kept (default {PREFETCH_SIZE}, 0 to disable).")
 
 	args = parser.parse_args()
 
@@ -693,7 +1275,7 @@ def main():
 
 	# run the server
 	manager = Manager(path, args.verbose, mon=mon, single=args.single)
-	MyServer(manager).run()
+	MyServer(manager, max(args.jobs, 1), max(args.prefetch, 0)).run()
 
 
 if __name__ == "__main__":
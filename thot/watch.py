@@ -0,0 +1,190 @@
+# watch -- watch of file modifications
+# Copyright (C) 2024  <hugues.casse@laposte.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Watch of modifications of a set of files.
+
+A watcher is built with make_watcher(fun) and the files are added with
+watch(). Once started, the watcher calls fun with the list of modified
+paths (modified, replaced, removed) from its own thread. The
+modifications close in time are reported in one call.
+
+On Linux, the watcher uses inotify on the directories containing the
+watched files. Else, the files are periodically checked by stat()."""
+
+import ctypes
+import ctypes.util
+import os
+import os.path
+import select
+import struct
+import threading
+import time
+
+# Delay in seconds to gather the modifications.
+DELAY = .1
+
+# Period in seconds of check of the polling watcher.
+PERIOD = .5
+
+
+class Watcher:
+	"""Base class of watchers."""
+
+	def __init__(self, fun):
+		self.fun = fun
+		self.paths = set()
+		self.lock = threading.Lock()
+		self.thread = None
+		self.running = False
+
+	def watch(self, path):
+		"""Add a file to watch. Nothing is done if the file is
+		already watched."""
+		path = os.path.abspath(path)
+		with self.lock:
+			if path not in self.paths:
+				self.paths.add(path)
+				self.add(path)
+
+	def add(self, path):
+		"""Called to start the watch of the given path (the watcher
+		is locked)."""
+		pass
+
+	def start(self):
+		"""Start the watch in a separate thread."""
+		self.running = True
+		self.thread = threading.Thread(target = self.run, daemon = True)
+		self.thread.start()
+
+	def stop(self):
+		"""Stop the watch."""
+		self.running = False
+
+	def run(self):
+		"""Body of the watching thread."""
+		pass
+
+
+class PollWatcher(Watcher):
+	"""Watcher checking all the files by stat() each PERIOD."""
+
+	def __init__(self, fun):
+		Watcher.__init__(self, fun)
+		self.stamps = {}
+
+	def get_stamp(self, path):
+		try:
+			stat = os.stat(path)
+			return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+		except OSError:
+			return None
+
+	def add(self, path):
+		self.stamps[path] = self.get_stamp(path)
+
+	def run(self):
+		while self.running:
+			time.sleep(PERIOD)
+			with self.lock:
+				paths = list(self.stamps.items())
+			changed = []
+			for (path, old) in paths:
+				stamp = self.get_stamp(path)
+				if stamp != old:
+					changed.append(path)
+					with self.lock:
+						self.stamps[path] = stamp
+			if changed:
+				self.fun(changed)
+
+
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+	| IN_CREATE | IN_DELETE
+EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher(Watcher):
+	"""Watcher based on Linux inotify: the directories of the files are
+	watched to also catch the files replaced by renaming."""
+
+	def __init__(self, fun, libc, fd):
+		Watcher.__init__(self, fun)
+		self.libc = libc
+		self.fd = fd
+		self.dirs = {}
+		self.wds = {}
+
+	def add(self, path):
+		dir = os.path.dirname(path)
+		if dir not in self.dirs:
+			wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir), IN_MASK)
+			if wd >= 0:
+				self.dirs[dir] = wd
+				self.wds[wd] = dir
+
+	def read(self):
+		"""Read the available events and return the modified paths."""
+		buf = os.read(self.fd, 65536)
+		paths = set()
+		off = 0
+		while off < len(buf):
+			wd, _, _, size = EVENT.unpack_from(buf, off)
+			off += EVENT.size
+			name = os.fsdecode(buf[off:off + size].rstrip(b"\0"))
+			off += size
+			with self.lock:
+				try:
+					path = os.path.join(self.wds[wd], name)
+				except KeyError:
+					continue
+				if path in self.paths:
+					paths.add(path)
+		return paths
+
+	def run(self):
+		changed = set()
+		while self.running:
+			if changed:
+				timeout = DELAY
+			else:
+				timeout = PERIOD
+			ready, _, _ = select.select([self.fd], [], [], timeout)
+			if ready:
+				changed |= self.read()
+			elif changed:
+				self.fun(sorted(changed))
+				changed = set()
+		os.close(self.fd)
+
+
+def make_watcher(fun):
+	"""Build a watcher calling fun with the list of modified paths,
+	using inotify if available."""
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+		fd = libc.inotify_init1(os.O_CLOEXEC)
+		if fd >= 0:
+			return InotifyWatcher(fun, libc, fd)
+	except (OSError, AttributeError, TypeError):
+		pass
+	return PollWatcher(fun)